@@ -16,7 +16,14 @@ import matplotlib.pyplot as plt
 import sys
 import time
 output_stream = sys.stdout
-from mro.utils import get_n_processes, cluster_data
+from mro.utils import get_n_processes, cluster_path
+from mro.formulation import affine_collapsible, collapse_affine, mro_constraints
+from mro.results import ResultRecorder, ResultAggregator
+from mro.store import SolutionStore
+from mro.datasets import DatasetRegistry, resolve
+from mro.evaluation import facility_eval, facility_eval_k, stream_eval, sequential_eval, add_interval
+from mro.problems import cached_problem, compile_problem, solve_eps_path
+from mro.search import K_converged
 
 def prob_facility_separate(K, m, n):
     """Create the problem in cvxpy
@@ -53,10 +60,9 @@ def prob_facility_separate(K, m, n):
     for j in range(m):
         constraints += [cp.sum(X[:, j]) == 1]
     for i in range(n):
-        constraints += [cp.multiply(eps, lmbda[i]) + wk @ s[i] <= 0]
-        constraints += [cp.hstack([-p[i]*x[i]]*K) + d_train@X[i] +
-                        cp.hstack([cp.quad_over_lin(X[i], 4*lmbda[i])]*K) <= s[i]]
-    constraints += [X >= 0, lmbda >= 0]
+        constraints += mro_constraints(d_train, wk, eps, lmbda[i], s[i],
+                                       -p[i]*x[i], X[i])
+    constraints += [X >= 0]
 
     problem = cp.Problem(objective, constraints)
 
@@ -119,118 +125,148 @@ def generate_facility_demands(N, m, R):
     return d_train
 
 
-def evaluate(p, x, X, d):
-    """Evaluate constraint satisfaction
-    Parameters
-    ----------
-    p: vector
-        Prices
-    x: vector
-        Decision variables of the optimization problem
-    X: matrix
-        Decision variables of the optimization problem
-    d: matrix
-        Validation data matrix
-    Returns:
-    -------
-    boolean: indicator of constraint satisfaction 
-    """
-    for ind in range(n):
-        if -p.value[ind]*x.value[ind] + np.reshape(np.mean(d, axis=0), (1, m))@(X.value[ind]) >= 0.001:
-            return 0
-    return 1
-
-
-def evaluate_k(p, x, X, d):
-    """Evaluate stricter constraint satisfaction
-    Parameters
-    ----------
-    p: vector
-        Prices
-    x: vector
-        Decision variables of the optimization problem
-    X: matrix
-        Decision variables of the optimization problem
-    d: matrix
-        Validation data matrix
-    Returns:
-    -------
-    boolean: indicator of constraint satisfaction 
-    """
-    maxval = np.zeros((np.shape(d)[0], np.shape(x)[0]))
-    for fac in range(np.shape(x)[0]):
-        for ind in range(np.shape(d)[0]):
-            maxval[ind, fac] = -p.value[fac]*x.value[fac] + d[ind]@X.value[fac]
-    print(np.mean(np.max(maxval, axis=1)))
-    if np.mean(np.max(maxval, axis=1)) >= 0.001:
-        return 0
-    return 1
-
-
-def facility_experiment(r, n, m, Data, Data_eval, prob_facility, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername):
+def facility_experiment(r, n, m, Data, Data_eval, c, C, p, prob_facility, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, sequential=None, K_tol=None, clustering=None, store=None):
     '''Run the experiment for multiple K and epsilon
     Parameters
     ----------
-    Various inputs for combinations of experiments
+    Various inputs for combinations of experiments, the datasets being
+    arrays or references of a mro.datasets.DatasetRegistry
+    sequential: dict
+        If given, evaluate with mro.evaluation.sequential_eval using these
+        keyword arguments, and add the interval of Eval_val1 to the results
+    K_tol: float
+        If given, stop increasing K once the change in objective over all
+        epsilons is within K_tol
+    clustering: dict
+        Keyword arguments of mro.utils.cluster_path, e.g.
+        {"method": "stream", "chunk_size": 10000}
+    store: mro.store.SolutionStore
+        If given, write the optimal solutions in slice r of its tensors
+        instead of returning them
     Returns
     -------
     x_sols: array
-        The optimal solutions for x
+        The optimal solutions for x, None if written in store
     X_sols: array
-        The optimal solutions for X
-    df: dataframe
-        The results of the experiments
+        The optimal solutions for X, None if written in store
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
     '''
     X_sols = np.zeros((K_tot, eps_tot, n, m))
     x_sols = np.zeros((K_tot, eps_tot, n))
-    df = pd.DataFrame(columns=["K", "Epsilon", "Opt_val", "Eval_val",
-                      "Eval_val1", "solvetime", "setuptime", "clustertime"])
+    rec = ResultRecorder(K_tot*eps_tot, {
+        "K": int, "Epsilon": float, "Opt_val": float, "Eval_val": int, "Eval_val1": int,
+        "solvetime": float, "iters": float, "setuptime": float, "clustertime": float})
+    Data, Data_eval = resolve(Data), resolve(Data_eval)
+    clusters = cluster_path(Data[:, :, r], K_nums, lazy=K_tol is not None,
+                            **(clustering or {}))
+    probe = cached_problem(prob_facility, 1, m, n)
+    collapse = affine_collapsible(probe[0], probe[5])
 
-    ######################## solve for various K ########################
-    for K_count, K in enumerate(K_nums):
-        if K == N_tot:
-            d_train, wk = cluster_data(Data[:, :, r], K)
-            clustertimes = 0
-        else:
-            tnow = time.time()
-            d_train, wk = cluster_data(Data[:, :, r], K)
-            clustertimes = time.time() - tnow
+    dat_eval = Data_eval[:, :, r]
 
-        dat_eval = Data_eval[:, :, r]
+    ######################## solve for various K ########################
+    res_prev = None
+    for K_count, (K, (d_train, wk, _, clustertimes)) in enumerate(zip(K_nums, clusters)):
+        if collapse:
+            d_train, wk = collapse_affine(d_train, wk)
         tnow = time.time()
-        problem, x, X, s, lmbda, data_train_pm, w_pm, eps_pm, p_pm, c_pm, C_pm = prob_facility(
-            K, m, n)
+        problem, x, X, s, lmbda, data_train_pm, w_pm, eps_pm, p_pm, c_pm, C_pm = cached_problem(
+            prob_facility, d_train.shape[0], m, n)
         data_train_pm.value = d_train
         w_pm.value = wk
         p_pm.value = p
         c_pm.value = c
         C_pm.value = C
-
+        eps_pm.value = eps_nums[0]
+        compile_problem(problem)
         setuptimes = time.time() - tnow
 
         ############## solve for various epsilons ###################
-        for eps_count, eps in enumerate(eps_nums):
-            eps_pm.value = eps
-            problem.solve()
+        for eps_count, eps, iters in solve_eps_path(problem, eps_pm, eps_nums):
             X_sols[K_count, eps_count, :, :] = X.value
             x_sols[K_count, eps_count, :] = x.value
-            evalvalue = evaluate(p_pm, x, X, dat_eval)
-            evalvalue1 = evaluate_k(p_pm, x, X, dat_eval)
-            newrow = pd.Series(
+            rec.append(
                 {"K": K,
                  "Epsilon": eps,
                  "Opt_val": problem.objective.value,
-                 "Eval_val": evalvalue,
-                 "Eval_val1": evalvalue1,
                  "solvetime": problem.solver_stats.solve_time,
+                 "iters": iters,
                  "setuptime": setuptimes,
                  "clustertime": clustertimes
                  })
-            df = df.append(newrow, ignore_index=True)
             #df.to_csv('/scratch/gpfs/iywang/mro_results/' +
             #          foldername + '/df.csv')
+        if K_tol is not None:
+            res = rec.select(rec["K"] == K)
+            if K_converged(res, res_prev, K_tol):
+                break
+            res_prev = res
+
+    rec["Eval_val"] = (stream_eval(facility_eval, dat_eval, p, x_sols[:K_count + 1], X_sols[:K_count + 1]) < 0.001).ravel().astype(int)
+    if sequential is None:
+        rec["Eval_val1"] = (stream_eval(facility_eval_k, dat_eval, p, x_sols[:K_count + 1], X_sols[:K_count + 1]) < 0.001).ravel().astype(int)
+    else:
+        res = sequential_eval(facility_eval_k, dat_eval, p, x_sols[:K_count + 1], X_sols[:K_count + 1], bound=0.001, **sequential)
+        rec["Eval_val1"] = res["satisfy"].ravel().astype(int)
+        add_interval(rec, res)
+
+    if store is not None:
+        store.write("X_sols", np.s_[..., r], X_sols)
+        store.write("x_sols", np.s_[..., r], x_sols)
+        X_sols, x_sols = None, None
+    return X_sols, x_sols, rec.buffers()
+
+
+def setup(config):
+    """Build the inputs of run_task from a runner config
+    Parameters
+    ----------
+    config: dict
+        Runner config, with "n", "m", "N_tot", "R", and optionally
+        "seed", "foldername", "sequential" and "clustering"
+    Returns
+    -------
+    dict
+        The data of every task
+    """
+    np.random.seed(config.get("seed", 0))
+    n, m = config["n"], config["m"]
+    c, C, p = generate_facility_data(n, m)
+    return {"Data": generate_facility_demands(config["N_tot"], m, config["R"]),
+            "Data_eval": generate_facility_demands(config["N_tot"], m, config["R"]),
+            "n": n, "m": m, "c": c, "C": C, "p": p,
+            "N_tot": config["N_tot"],
+            "foldername": config.get("foldername", ""),
+            "sequential": config.get("sequential"),
+            "clustering": config.get("clustering")}
 
-    return X_sols, x_sols, df
+
+def run_task(data, r, K_nums, eps_nums):
+    """Run facility_experiment for one replicate on part of the grid
+    Parameters
+    ----------
+    data: dict
+        Output of setup
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters
+    eps_nums: vector
+        Epsilons
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K and epsilon axes first
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
+    """
+    X_sols, x_sols, df = facility_experiment(
+        r, data["n"], data["m"], data["Data"], data["Data_eval"], data["c"], data["C"], data["p"],
+        prob_facility_separate, data["N_tot"], len(K_nums), K_nums, len(eps_nums), eps_nums,
+        data["foldername"], sequential=data["sequential"],
+        clustering=data["clustering"])
+    return {"X_sols": X_sols, "x_sols": x_sols}, df
 
 
 if __name__ == '__main__':
@@ -248,28 +284,23 @@ if __name__ == '__main__':
     eps_max = 30         # maximum epsilon we consider
     eps_nums = np.linspace(eps_min, eps_max, M)
     eps_tot = M
+    K_tol = None    # stop increasing K once the objective changes by less
     c, C, p = generate_facility_data(n, m)
     Data = generate_facility_demands(N_tot, m, R)
     Data_eval = generate_facility_demands(N_tot, m, R)
 
     njobs = get_n_processes(30)
-    results = Parallel(n_jobs=njobs)(delayed(facility_experiment)(r, n, m, Data, Data_eval,
-                                                                  prob_facility_separate, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername) for r in range(R))
-
-    X_sols = np.zeros((K_tot, eps_tot, n, m, R))
-    x_sols = np.zeros((K_tot, eps_tot, n, R))
-    dftemp = results[0][2]
-
-    for r in range(R):
-        X_sols[:, :, :, :, r] = results[r][0]
-        x_sols[:, :, :, r] = results[r][1]
-    for r in range(1, R):
-        dftemp = dftemp.add(results[r][2].reset_index(), fill_value=0)
-    dftemp = dftemp/R
-
-    #np.save(Path("/scratch/gpfs/iywang/mro_results/" +
-    #        foldername + "/x_sols.npy"), x_sols)
-    #np.save(Path("/scratch/gpfs/iywang/mro_results/" +
-    #        foldername + "/X_sols.npy"), X_sols)
+    with DatasetRegistry() as registry:
+        Data, Data_eval = registry.add("Data", Data), registry.add("Data_eval", Data_eval)
+        store = SolutionStore("/scratch/gpfs/iywang/mro_results/" + foldername, sparse=("X_sols",))
+        store.create("X_sols", (K_tot, eps_tot, n, m, R), reset=True)
+        store.create("x_sols", (K_tot, eps_tot, n, R), reset=True)
+        results = Parallel(n_jobs=njobs, return_as="generator")(delayed(facility_experiment)(r, n, m, Data, Data_eval, c, C, p,
+                                                                      prob_facility_separate, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, K_tol=K_tol, store=store) for r in range(R))
+
+        agg = ResultAggregator()
+        for _, _, df_r in results:
+            agg.update(df_r)
+    dftemp = agg.to_frame()
 
     dftemp.to_csv('/scratch/gpfs/iywang/mro_results/' + foldername + '/df.csv')
@@ -6,10 +6,16 @@ import mosek
 import time
 import numpy as np
 import cvxpy as cp
+from scipy.optimize import brentq
 import matplotlib.pyplot as plt
 import pandas as pd
 import sys
-from mro.utils import get_n_processes, cluster_data
+from mro.utils import get_n_processes, cluster_path
+from mro.formulation import tile_rows
+from mro.results import ResultRecorder, ResultAggregator
+from mro.evaluation import logsumexp_eval, stream_eval, sequential_eval, add_interval
+from mro.search import K_converged
+from mro.problems import cached_problem
 
 
 def dat_scaled(N, m,scale):
@@ -73,49 +79,131 @@ def createproblem_max(N, m,w):
     
     u = cp.Variable((N,m))
     
-    objective = cp.sum([w[k]*cp.log(u[k]@expx) for k in range(N)])
+    objective = w@cp.log(u@expx)
     # CONSTRAINTS #
-    constraints = [cp.sum([cp.quad_over_lin(u[k]-dat[k], 1/w[k]) for k in range(N)])<= eps]
+    constraints = [cp.sum_squares(cp.multiply(np.outer(np.sqrt(w), np.ones(m)), u - dat)) <= eps]
 
     # PROBLEM #
     problem = cp.Problem(cp.Maximize(objective), constraints)
     return problem, u,expx,dat,eps
 
 
-def createproblem_min(N, m,w,Uvals,n_planes):
+def solvemax_dual(w, data, expx, epsilon):
+    """Solve the maximization problem through its dual multiplier
+    For a fixed multiplier mu of the budget constraint, each cluster
+    solves max_u log(u@expx) - mu*||u - data[k]||^2 in closed form, with
+    u - data[k] along expx, and the budget used decreases in mu. The
+    multiplier matching epsilon is found by a 1-D root search, so that
+    every evaluation is a vectorized pass over the clusters.
+    Parameters:
+    ----------
+    w: vector
+        Weights for each data sample
+    data: matrix
+        Input data
+    expx: vector
+        Exponential of the current x
+    epsilon:
+        Input epsilon
+    Returns:
+    -------
+    u: matrix
+        Worst-case data samples
+    """
+    c = data@expx
+    a2 = expx@expx
+    if epsilon <= 0:
+        return data.copy()
+
+    def s_of(log_mu):
+        # s = u@expx solves s^2 - c*s - a2/(2*mu) = 0
+        return (c + np.sqrt(c**2 + 2*a2*np.exp(-log_mu)))/2
+
+    def budget(log_mu):
+        return np.log(w@(a2/(4*np.exp(2*log_mu)*s_of(log_mu)**2))) - np.log(epsilon)
+
+    lo = hi = np.log(np.sqrt(a2*(w@(1/c**2))/(4*epsilon)))
+    while budget(lo) < 0:
+        lo -= 1
+    while budget(hi) > 0:
+        hi += 1
+    log_mu = brentq(budget, lo, hi, xtol=1e-12)
+    s = s_of(log_mu)
+    return data + np.outer(1/(2*np.exp(log_mu)*s), expx)
+
+
+def createproblem_min(N, m, n_cuts):
     """Create minimization problem to ensure constraint satisfaction
+    The problem holds a pool of n_cuts cutting planes, each with its own
+    Parameter, so that it is DPP and compiled once, and a cut is added by
+    setting a Parameter with add_cut. The slots not used yet repeat a cut
+    already set.
     Parameters:
     ----------
     N: int
         Number of data samples
     m: int
         Size of each data sample
-    w: vector
-        Weights for each data sample
-    Uvals: dict
-        Set of uncertainty realizatoins
-    n_planes: 
-        Number of cutting planes added
+    n_cuts: int
+        Number of cutting planes of the pool
     Returns:
     -------
-    The cvxpy problem and parameters
+    The cvxpy problem, variable x, and parameters of the weights and of
+    the uncertainty realization of each cut
     """
-    # PARAMETERS #    
+    # PARAMETERS #
+    w = cp.Parameter(N, nonneg=True)
+    U = [cp.Parameter((N, m)) for _ in range(n_cuts)]
+
+    # VARIABLES #
     x = cp.Variable(m)
     t = cp.Variable()
+    z = [cp.Variable(N) for _ in range(n_cuts)]
     objective = t
     
     # CONSTRAINTS #
     constraints = [cp.sum(x) >= 10, x>= 0, x <= 10]
-    for index in range(n_planes):
-        constraints += [cp.sum([w[k]*cp.log_sum_exp(x + Uvals[index][k]) for k in range(N)]) <= t]
+    for U_j, z_j in zip(U, z):
+        constraints += [cp.log_sum_exp(tile_rows(x, N) + U_j, axis=1) <= z_j, w@z_j <= t]
     # PROBLEM #
     problem = cp.Problem(cp.Minimize(objective), constraints)
-    return problem, x
-  
+    return problem, x, w, U
+
+
+def add_cut(pool, cuts, U):
+    """Add a cutting plane to the minimization problem
+    The cut is set in the first free slot of the pool. A full pool is
+    replaced by the pool one cut larger, or twice as large beyond 8 cuts,
+    each pool being built and compiled once per process and reused by the
+    later calls of minmaxsolve, so that long runs of cuts compile a
+    logarithmic number of pools and the free slots stay few.
+    Parameters:
+    ----------
+    pool: tuple
+        Output of createproblem_min
+    cuts: list
+        Uncertainty realizations of the cuts already set, U is appended
+    U: matrix
+        Uncertainty realization of the cut
+    Returns:
+    -------
+    The pool holding all the cuts
+    """
+    cuts.append(U)
+    if len(cuts) > len(pool[3]):
+        weights = pool[2].value
+        n_cuts = len(cuts) if len(cuts) <= 8 else 2*len(pool[3])
+        pool = cached_problem(createproblem_min, U.shape[0], U.shape[1], n_cuts)
+        pool[2].value = weights
+    for cut_count, U_j in enumerate(pool[3]):
+        U_j.value = cuts[min(cut_count, len(cuts) - 1)]
+    return pool
+
 
-def minmaxsolve(N,m,w,data,epsilon):
+def minmaxsolve(N,m,w,data,epsilon,oracle="cvxpy"):
     """Cutting plane procedure
+    The cuts are set in a pool of cutting planes compiled once, see
+    add_cut.
     Parameters:
     ----------
     N: int
@@ -128,6 +216,9 @@ def minmaxsolve(N,m,w,data,epsilon):
         Input data
     epsilon: 
         Input epsilon
+    oracle: str
+        Solver of the maximization problem, "cvxpy" or "dual" for
+        solvemax_dual
     Returns:
     -------
     objs2:
@@ -138,74 +229,155 @@ def minmaxsolve(N,m,w,data,epsilon):
         Total solvertime 
     inds: 
         Number of cutting planes added
+    itertimes:
+        Wall-clock time of each iteration
     """
-    Uvals = {}
     inds = 0
-    Uvals[inds] = np.log(data)
-    inds += 1
     solvetime = 0
-    problem1, x= createproblem_min(N, m,w,Uvals,inds)
+    itertimes = []
+    tnow = time.time()
+    pool = cached_problem(createproblem_min, N, m, 1)
+    pool[2].value = w
+    cuts = []
+    pool = add_cut(pool, cuts, np.log(data))
+    problem1, x = pool[:2]
+    inds += 1
     problem1.solve()
-    objs1 = problem1.objective.value
     solvetime += problem1.solver_stats.solve_time
+    itertimes.append(time.time() - tnow)
+    objs1 = np.inf
+    objs2 = problem1.objective.value
     problem, u,expx,dat,eps= createproblem_max(N, m,w)
     dat.value = data
     eps.value = epsilon
-    expx.value = np.exp(x.value)
-    problem.solve()
-    solvetime += problem.solver_stats.solve_time
-    Uvals[inds] = np.log(u.value)
-    inds += 1
-    problem1, x= createproblem_min(N, m,w,Uvals,inds)
-    problem1.solve()
-    solvetime += problem1.solver_stats.solve_time
-    objs2 = problem1.objective.value
     while(np.abs(objs1 - objs2)>= 0.0001 and inds <= 50):
-        expx.value = np.exp(x.value)
-        problem.solve()
-        solvetime += problem.solver_stats.solve_time
-        Uvals[inds] = np.log(u.value)
+        tnow = time.time()
+        if oracle == "dual":
+            tmax = time.time()
+            u_val = solvemax_dual(w, data, np.exp(x.value), epsilon)
+            solvetime += time.time() - tmax
+        else:
+            expx.value = np.exp(x.value)
+            problem.solve()
+            solvetime += problem.solver_stats.solve_time
+            u_val = u.value
+        pool = add_cut(pool, cuts, np.log(u_val))
+        problem1, x = pool[:2]
         inds += 1
-        problem1, x= createproblem_min(N, m,w,Uvals,inds)
         problem1.solve()
         solvetime += problem1.solver_stats.solve_time
+        itertimes.append(time.time() - tnow)
         objs1 = objs2
         objs2 = problem1.objective.value
-    return objs2, x.value, solvetime, inds
+    return objs2, x.value, solvetime, inds, itertimes
     
-def logsumexp_experiment(r, m, N_tot, K_nums, eps_nums, foldername):
+def logsumexp_experiment(r, m, N_tot, K_nums, eps_nums, foldername, K_tol=None, clustering=None, sequential=None):
     '''Run the experiment for multiple K and epsilon
     Parameters
     ----------
     Various inputs for combinations of experiments
+    K_tol: float
+        If given, stop increasing K once the bound or the change in
+        objective over all epsilons is within K_tol
+    clustering: dict
+        Keyword arguments of mro.utils.cluster_path, e.g.
+        {"method": "stream", "chunk_size": 10000}
+    sequential: dict
+        If given, evaluate with mro.evaluation.sequential_eval using these
+        keyword arguments, and add the interval to the results
     Returns
     -------
-    df: dataframe
-        The results of the experiments
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
     '''
-    df = pd.DataFrame(columns = ["r","K","Epsilon","Opt_val","Eval_val","satisfy","solvetime","bound","iters"])
+    rec = ResultRecorder(len(K_nums)*len(eps_nums), {
+        "r": int, "K": int, "Epsilon": float, "Opt_val": float, "Eval_val": float, "satisfy": bool,
+        "solvetime": float, "bound": float, "iters": float, "itertime": float})
     d = data_modes(N_tot,m,[1,3,7])
     d2 = data_modes(N_tot,m,[1,3,7])
-    for Kcount, K in enumerate(K_nums):
-        kmeans = KMeans(n_clusters=K).fit(d)
-        weights = np.bincount(kmeans.labels_) / N_tot
+    xsols = np.zeros((len(K_nums), len(eps_nums), m))
+    clusters = cluster_path(d, K_nums, lazy=K_tol is not None,
+                            **(clustering or {}))
+    res_prev = None
+    for Kcount, (K, (centers, weights, inertia, _)) in enumerate(zip(K_nums, clusters)):
         for epscount, epsval in enumerate(eps_nums):
-            objs_val,x_val,time,iters = minmaxsolve(K,m,weights,kmeans.cluster_centers_,epsval**2)
-            evalvalue = cp.sum([(1/N_tot)*cp.log_sum_exp(x_val + np.log(d2[k])).value for k in range(N_tot)])
-            newrow = pd.Series(
+            objs_val,x_val,time,iters,itertimes = minmaxsolve(centers.shape[0],m,weights,centers,epsval**2,oracle="dual")
+            xsols[Kcount, epscount] = x_val
+            rec.append(
                 {"r":r,
                 "K": K,
                 "Epsilon": epsval,
                 "Opt_val": objs_val,
-                "Eval_val": evalvalue,
-                "satisfy": evalvalue <= objs_val,
                 "solvetime": time,
-                "bound": (1/(2*N_tot))*kmeans.inertia_,
-                "iters": iters
+                "bound": (1/(2*N_tot))*inertia,
+                "iters": iters,
+                "itertime": np.mean(itertimes)
             })
-            df = df.append(newrow,ignore_index = True)
+        if K_tol is not None:
+            res = rec.select(rec["K"] == K)
+            if K_converged(res, res_prev, K_tol):
+                break
+            res_prev = res
+    if sequential is None:
+        rec["Eval_val"] = stream_eval(logsumexp_eval, d2, xsols[:Kcount + 1]).ravel()
+        rec["satisfy"] = rec["Eval_val"] <= rec["Opt_val"]
+    else:
+        res = sequential_eval(logsumexp_eval, d2, xsols[:Kcount + 1],
+                              bound=rec["Opt_val"].reshape(Kcount + 1, -1),
+                              **sequential)
+        rec["Eval_val"] = res["value"].ravel()
+        rec["satisfy"] = res["satisfy"].ravel()
+        add_interval(rec, res)
+
+    return rec.buffers()
+
 
-    return df
+def setup(config):
+    """Build the inputs of run_task from a runner config
+    Parameters
+    ----------
+    config: dict
+        Runner config, with "m", "N_tot", and optionally "seed",
+        "foldername", "sequential" and "clustering"
+    Returns
+    -------
+    dict
+        The data of every task
+    """
+    return {"m": config["m"],
+            "N_tot": config["N_tot"],
+            "seed": config.get("seed", 0),
+            "foldername": config.get("foldername", ""),
+            "sequential": config.get("sequential"),
+            "clustering": config.get("clustering")}
+
+
+def run_task(data, r, K_nums, eps_nums):
+    """Run logsumexp_experiment for one replicate on part of the grid
+    The data of the replicate is drawn from a seed depending on r only,
+    so that all the tasks of a replicate share it.
+    Parameters
+    ----------
+    data: dict
+        Output of setup
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters
+    eps_nums: vector
+        Epsilons
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K and epsilon axes first
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
+    """
+    np.random.seed([data["seed"], r])
+    df = logsumexp_experiment(r, data["m"], data["N_tot"], K_nums, eps_nums,
+                              data["foldername"], sequential=data["sequential"],
+                              clustering=data["clustering"])
+    return {}, df
 
 
 if __name__ == '__main__':
@@ -215,15 +387,16 @@ if __name__ == '__main__':
     R = 30
     K_nums = np.append([1,2,3,5,6,7,8,10],np.append(np.arange(20, int(N_tot/2)+1,10), N_tot))
     eps_nums = np.append(np.logspace(-5.5,-4,20),np.logspace(-3.9,1,10))
+    K_tol = None    # stop increasing K once the objective changes by less
     
     njobs = get_n_processes(30)
-    results = Parallel(n_jobs=njobs)(delayed(logsumexp_experiment)(
-        r, m, N_tot, K_nums, eps_nums, foldername) for r in range(R))
+    results = Parallel(n_jobs=njobs, return_as="generator")(delayed(logsumexp_experiment)(
+        r, m, N_tot, K_nums, eps_nums, foldername, K_tol=K_tol) for r in range(R))
     
-    dftemp = results[0]
-    for r in range(1, R):
-        dftemp = dftemp.add(results[r].reset_index(), fill_value=0)
-    dftemp = dftemp/R
+    agg = ResultAggregator()
+    for df_r in results:
+        agg.update(df_r)
+    dftemp = agg.to_frame()
 
     dftemp.to_csv('/scratch/gpfs/iywang/mro_results/' + foldername + '/df.csv')
 
@@ -0,0 +1,214 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Arrays opened by resolve in this process, by path
+_VIEWS = {}
+
+
+class DatasetRef:
+    """Reference to an array of a DatasetRegistry, cheap to pickle
+    Parameters
+    ----------
+    path: str
+        Path of the .npy file holding the array
+    shape: tuple
+        Shape of the array
+    dtype: str
+        Data type of the array
+    """
+
+    def __init__(self, path, shape, dtype):
+        self.path = str(path)
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def __repr__(self):
+        return "DatasetRef(%r, %r, %r)" % (self.path, self.shape, self.dtype)
+
+
+def resolve(data):
+    """Return the read-only array of a reference
+    Each file is memory-mapped once per process, and its pages are shared
+    by all the processes reading it.
+    Parameters
+    ----------
+    data: DatasetRef, dict or other
+        Reference, or dict whose values are resolved, other values being
+        returned unchanged
+    Returns
+    -------
+    array, dict or other
+        The data, with the references replaced by their arrays
+    """
+    if isinstance(data, dict):
+        return {key: resolve(val) for key, val in data.items()}
+    if not isinstance(data, DatasetRef):
+        return data
+    if data.path not in _VIEWS:
+        _VIEWS[data.path] = np.load(data.path, mmap_mode="r")
+    return _VIEWS[data.path]
+
+
+def _shared_folder():
+    """Folder in shared memory if the system has one, else the temporary folder"""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class DatasetRegistry:
+    """Input datasets written once and shared by name with the workers
+    Each array is saved as a .npy file, in shared memory (/dev/shm) by
+    default, and the workers receive a DatasetRef in place of the array,
+    so that dispatching a task does not copy the data. The workers get
+    the array with resolve, as a read-only memory-mapped view.
+    Parameters
+    ----------
+    folder: str or Path
+        Folder of the files, a new temporary folder removed by close by
+        default
+    """
+
+    def __init__(self, folder=None):
+        self.owned = folder is None
+        if folder is None:
+            folder = tempfile.mkdtemp(prefix="mro_data_", dir=_shared_folder())
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.refs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.refs[name]
+
+    def add(self, name, array):
+        """Write an array once and return its reference
+        Parameters
+        ----------
+        name: str
+            Name of the dataset
+        array: array
+            Data
+        Returns
+        -------
+        DatasetRef
+            Reference to pass to the workers
+        """
+        if name in self.refs:
+            raise ValueError("Dataset %s is already registered" % name)
+        array = np.ascontiguousarray(array)
+        path = self.folder / (name + ".npy")
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+        self.refs[name] = DatasetRef(path, array.shape, array.dtype.str)
+        return self.refs[name]
+
+    def share(self, data, min_bytes=2**20):
+        """Register the large arrays of a dict
+        Parameters
+        ----------
+        data: dict
+            Inputs of the tasks, e.g. the output of a setup function
+        min_bytes: int
+            Size from which an array is registered
+        Returns
+        -------
+        dict
+            The data, with the registered arrays replaced by references
+        """
+        return {key: self.add(key, val)
+                if isinstance(val, np.ndarray) and val.nbytes >= min_bytes else val
+                for key, val in data.items()}
+
+    def close(self):
+        """Remove the files, if the registry created its folder"""
+        for ref in self.refs.values():
+            _VIEWS.pop(ref.path, None)
+        self.refs = {}
+        if self.owned:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _file_sha256(path):
+    """Checksum of the content of a file"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _csv_to_npy(path, target, index):
+    """Parse a CSV file once and save it column by column as .npy"""
+    df = pd.read_csv(path)
+    if index:
+        df = df.iloc[:, 1:]
+    array = np.asfortranarray(df.to_numpy(dtype=float))
+    tmp = "%s.%d.tmp" % (target, os.getpid())
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, target)
+    return [str(col) for col in df.columns]
+
+
+def load_csv(path, rows=slice(None), cols=slice(None), index=True, cache_dir=None):
+    """Load part of a numeric CSV file through a binary cache
+    The first call parses the CSV file and saves it as a column-major .npy
+    file, with a .json sidecar holding the checksum of the CSV file. The
+    later calls memory-map the .npy file, and read only the requested rows
+    and columns. The cache is rebuilt when the checksum no longer matches;
+    it is only computed when the size or modification time of the CSV
+    file changed.
+    Parameters
+    ----------
+    path: str or Path
+        Path of the CSV file, with a header line
+    rows: slice or array
+        Rows to read, all by default
+    cols: slice or array
+        Columns to read, all by default, after dropping the index
+    index: bool
+        Whether the first column holds the row labels, and is dropped
+    cache_dir: str or Path
+        Folder of the cache, the folder of the CSV file by default
+    Returns
+    -------
+    array
+        The requested rows and columns
+    """
+    path = Path(path)
+    cache_dir = path.parent if cache_dir is None else Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    target = cache_dir / (path.stem + ".npy")
+    sidecar = cache_dir / (path.stem + ".json")
+    stat = path.stat()
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "index": index}
+    try:
+        with open(sidecar) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = None
+    fresh = meta is not None and target.exists() and meta["index"] == index
+    if not fresh or (meta["size"], meta["mtime_ns"]) != (source["size"], source["mtime_ns"]):
+        source["sha256"] = _file_sha256(path)
+        if fresh and meta["sha256"] == source["sha256"]:
+            source["columns"] = meta["columns"]
+        else:
+            source["columns"] = _csv_to_npy(path, target, index)
+        tmp = "%s.%d.tmp" % (sidecar, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(source, f)
+        os.replace(tmp, sidecar)
+    array = np.load(target, mmap_mode="r")
+    return np.array(array[rows][:, cols])
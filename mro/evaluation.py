@@ -0,0 +1,326 @@
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import stats
+from mro.utils import iter_chunks
+
+
+def portfolio_eval(d_eval, x, tao, per_sample=False):
+    """Evaluate the portfolio CVaR constraint on the evaluation data
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one sample per row
+    x: array
+        Stack of solutions with shape (..., m), e.g. (K, eps, m)
+    tao: array
+        Stack of CVaR thresholds with shape (...)
+    per_sample: bool
+        Whether to return the value on each sample, on a last axis, instead
+        of the average
+    Returns
+    -------
+    array
+        Value of the constraint for each solution, to compare with y
+    """
+    if per_sample:
+        return -5*(np.asarray(x) @ np.asarray(d_eval).T) - 5*np.asarray(tao)[..., None]
+    return -5*(x @ np.mean(d_eval, axis=0)) - 5*np.asarray(tao)
+
+
+def news_eval(d_eval, a, p, q, y, tao, t, per_sample=False):
+    """Evaluate the newsvendor CVaR constraint on the evaluation data
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one sample per row
+    a: vector
+        Costs
+    p: vector
+        Prices
+    q: array
+        Stack of order quantities with shape (..., m)
+    y: array
+        Stack of auxiliary variables with shape (..., m)
+    tao: array
+        Stack of CVaR thresholds with shape (...)
+    t: array
+        Stack of objective epigraph variables with shape (...)
+    per_sample: bool
+        Whether to return the value on each sample, on a last axis, instead
+        of the average
+    Returns
+    -------
+    array
+        Value of the constraint for each solution, satisfied if <= 0
+    """
+    cost = 50*(q @ a + 0.5*(y @ a)) - 40*np.asarray(tao) - np.asarray(t)
+    if per_sample:
+        return -50*(np.asarray(d_eval) @ p) + cost[..., None]
+    return -50*np.mean(d_eval @ p) + cost
+
+
+def facility_eval(d_eval, p, x, X):
+    """Evaluate the facility constraints in expectation
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one sample per row
+    p: vector
+        Prices
+    x: array
+        Stack of facility decisions with shape (..., n)
+    X: array
+        Stack of allocations with shape (..., n, m)
+    Returns
+    -------
+    array
+        Largest expected constraint value over the facilities, for each
+        solution
+    """
+    return np.max(X @ np.mean(d_eval, axis=0) - p*x, axis=-1)
+
+
+def facility_eval_k(d_eval, p, x, X, per_sample=False):
+    """Evaluate the facility constraints jointly, sample by sample
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one sample per row
+    p: vector
+        Prices
+    x: array
+        Stack of facility decisions with shape (..., n)
+    X: array
+        Stack of allocations with shape (..., n, m)
+    per_sample: bool
+        Whether to return the value on each sample, on a last axis, instead
+        of the average
+    Returns
+    -------
+    array
+        Average over the samples of the largest constraint value over the
+        facilities, for each solution
+    """
+    # one solution at a time, holding (samples, facilities) values only
+    x, X = np.asarray(x), np.asarray(X)
+    out = np.empty(X.shape[:-2] + ((d_eval.shape[0],) if per_sample else ()))
+    for ind in np.ndindex(*X.shape[:-2]):
+        vals = np.max(d_eval @ X[ind].T - p*x[ind], axis=-1)
+        out[ind] = vals if per_sample else np.mean(vals)
+    return out
+
+
+def logsumexp_eval(d_eval, x, per_sample=False):
+    """Evaluate the log-sum-exp loss on the evaluation data
+    The loss of a sample d is logsumexp(x + log d) = log(d @ exp(x)), so
+    that all samples and solutions are evaluated with one product, holding
+    one value per sample and solution.
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one positive sample per row
+    x: array
+        Stack of solutions with shape (..., m)
+    per_sample: bool
+        Whether to return the value on each sample, on a last axis, instead
+        of the average
+    Returns
+    -------
+    array
+        Average loss for each solution
+    """
+    x = np.asarray(x)
+    shift = np.max(x, axis=-1, keepdims=True)
+    with np.errstate(divide="ignore"):
+        vals = np.log(np.exp(x - shift) @ np.asarray(d_eval).T) + shift
+    return vals if per_sample else np.mean(vals, axis=-1)
+
+
+def quadratic_eval(d_eval, x, A):
+    """Evaluate the concave quadratic loss on the evaluation data
+    Averages -0.5 d_i^T M d_j over all pairs of samples, with
+    M = sum_l x[l] A[l], which is -0.5 mean(d)^T M mean(d).
+    Parameters
+    ----------
+    d_eval: array
+        Evaluation data, one sample per row
+    x: array
+        Stack of solutions with shape (..., m)
+    A: dict or array
+        Matrixes for the quadratic equation, indexed by 0, ..., m-1
+    Returns
+    -------
+    array
+        Average loss for each solution
+    """
+    A = np.asarray([A[i] for i in range(len(A))])
+    d_mean = np.mean(d_eval, axis=0)
+    return -0.5*(x @ np.einsum("i,lij,j->l", d_mean, A, d_mean))
+
+
+_MEAN_KERNELS = (portfolio_eval, news_eval, facility_eval, quadratic_eval)
+
+
+def _chunk_stats(kernel, block, args):
+    """Number of rows and sum over a block of the rows, or of the kernel"""
+    if kernel is None:
+        return block.shape[0], np.sum(block, axis=0)
+    return block.shape[0], block.shape[0]*kernel(block, *args)
+
+
+def stream_eval(kernel, D_in, *args, chunk_size=100000, max_values=2**24, n_jobs=1):
+    """Evaluate a kernel on evaluation data read in chunks
+    Kernels depending on the data only through its mean (portfolio_eval,
+    news_eval, facility_eval, quadratic_eval) are evaluated once on the
+    streamed mean. The other kernels, averages over the samples, are
+    accumulated chunk by chunk, with at most max_values values (rows
+    times solutions) per chunk, as these kernels hold one value per sample
+    and solution. The chunks are dispatched lazily, so that only a few of
+    them are held in memory at once.
+    Parameters
+    ----------
+    kernel: function
+        Evaluation kernel of this module
+    D_in: array, str or callable
+        Evaluation data, see mro.utils.iter_chunks
+    args:
+        Remaining arguments of the kernel
+    chunk_size: int
+        Maximum number of rows per chunk
+    max_values: int
+        Maximum number of rows times solutions per chunk, for the kernels
+        averaging over the samples
+    n_jobs: int
+        Number of processes evaluating the chunks
+    Returns
+    -------
+    array
+        Same as kernel on the full evaluation data
+    """
+    by_mean = kernel in _MEAN_KERNELS
+    if not by_mean:
+        n_sols = np.size(kernel(next(iter_chunks(D_in, 1)), *args))
+        chunk_size = min(chunk_size, max(1, max_values // n_sols))
+    chunk_stats = Parallel(n_jobs=n_jobs)(
+        delayed(_chunk_stats)(None if by_mean else kernel, block, args)
+        for block in iter_chunks(D_in, chunk_size))
+    N = sum(n for n, _ in chunk_stats)
+    total = sum(t for _, t in chunk_stats)
+    if by_mean:
+        return kernel((total/N)[None, :], *args)
+    return total/N
+
+
+def _welford_merge(n, mean, M2, block):
+    """Merge the mean and sum of squared deviations of a block of samples"""
+    nb = block.shape[0]
+    mean_b = np.mean(block, axis=0)
+    M2_b = np.sum((block - mean_b)**2, axis=0)
+    delta = mean_b - mean
+    tot = n + nb
+    return tot, mean + delta*nb/tot, M2 + M2_b + delta**2*n*nb/tot
+
+
+def _interval(n, mean, M2, method, z):
+    """Confidence interval on a mean, or a proportion for wilson"""
+    if method == "wilson":
+        center = (mean + z**2/(2*n))/(1 + z**2/n)
+        half = z/(1 + z**2/n)*np.sqrt(mean*(1 - mean)/n + z**2/(4*n**2))
+        return center - half, center + half
+    half = z*np.sqrt(M2/np.maximum(n - 1, 1)/n)
+    return mean - half, mean + half
+
+
+def sequential_eval(kernel, D_in, *args, bound=0., method="normal", alpha=0.05,
+                    tol=0., level=0.95, chunk_size=100, max_samples=None, seed=0):
+    """Evaluate a kernel on evaluation data drawn until the result is clear
+    The samples are read chunk by chunk in a random order, so that every
+    chunk is a sample of the whole data whatever its order (e.g. sorted
+    by mode, or by time), and the statistics of each
+    solution are updated with Welford's algorithm until its interval is
+    decided: for method "normal", the interval on the expected constraint
+    value no longer contains bound; for method "wilson", the interval on
+    the probability of the constraint holding for a sample no longer
+    contains level. Solutions are also decided once the half width of the
+    interval is below tol. The j-th check uses the level alpha/(j(j+1)),
+    so that the intervals hold jointly over all checks. Each chunk is
+    evaluated in one call of the kernel with per_sample set, so only the
+    kernels averaging per-sample values can be used, i.e. not
+    facility_eval or quadratic_eval.
+    Parameters
+    ----------
+    kernel: function
+        Evaluation kernel of this module
+    D_in: array, str or callable
+        Evaluation data, see mro.utils.iter_chunks
+    args:
+        Remaining arguments of the kernel
+    bound: float or array
+        Right hand side of the constraint, for each solution
+    method: str
+        "normal" or "wilson"
+    alpha: float
+        One minus the confidence level of the intervals
+    tol: float
+        Half width of the intervals below which the sampling stops
+    level: float
+        Target probability of the constraint holding, for "wilson"
+    chunk_size: int
+        Number of samples drawn between two checks
+    max_samples: int
+        Maximum number of samples, all the data by default
+    seed: int
+        Seed of the random order of the samples, see mro.utils.iter_chunks;
+        a callable D_in is only shuffled within its blocks, which should
+        be drawn at random
+    Returns
+    -------
+    dict
+        Arrays "value" (average kernel value, or probability for
+        "wilson"), "lower" and "upper" (confidence interval), "satisfy"
+        and "samples" (number of samples used), one entry per solution
+    """
+    if kernel in (facility_eval, quadratic_eval):
+        raise ValueError("%s is not an average over samples" % kernel.__name__)
+    threshold = level if method == "wilson" else bound
+    n = mean = M2 = 0.
+    active = None
+    rng = np.random.default_rng(seed)
+    for look, block in enumerate(iter_chunks(D_in, chunk_size, rng), 1):
+        if max_samples is not None and np.max(n) >= max_samples:
+            break
+        vals = np.moveaxis(kernel(block, *args, per_sample=True), -1, 0)
+        if method == "wilson":
+            vals = (vals <= bound).astype(float)
+        if active is None:
+            n, mean, M2 = _welford_merge(0, 0., 0., vals)
+            n = np.full(mean.shape, float(n))
+        else:
+            n_new, mean_new, M2_new = _welford_merge(n, mean, M2, vals)
+            n = np.where(active, n_new, n)
+            mean = np.where(active, mean_new, mean)
+            M2 = np.where(active, M2_new, M2)
+        z = stats.norm.ppf(1 - alpha/(2*look*(look + 1)))
+        lower, upper = _interval(n, mean, M2, method, z)
+        active = (lower <= threshold) & (upper >= threshold) & ((upper - lower)/2 > tol)
+        if not np.any(active):
+            break
+
+    lower, upper = _interval(n, mean, M2, method, z)
+    satisfy = mean >= level if method == "wilson" else mean <= bound
+    return {"value": mean, "lower": lower, "upper": upper,
+            "satisfy": satisfy, "samples": n.astype(int)}
+
+
+def add_interval(df, res):
+    """Add the interval and sample size of sequential_eval to the results
+    Parameters
+    ----------
+    df: dataframe or ResultRecorder
+        Results, one row per solution in the order of the stack
+    res: dict
+        Output of sequential_eval
+    """
+    df["lower"] = res["lower"].ravel()
+    df["upper"] = res["upper"].ravel()
+    df["eval_samples"] = res["samples"].ravel()
@@ -0,0 +1,211 @@
+import numpy as np
+import cvxpy as cp
+
+
+def _swap(expr, param, var):
+    """Copy expr with param replaced by var and every variable by a parameter
+    Parameters
+    ----------
+    expr: cvxpy expression
+        Expression to copy
+    param: cvxpy Parameter
+        Parameter to replace
+    var: cvxpy Variable
+        Variable replacing param
+    Returns
+    -------
+    The copied expression
+    """
+    if expr is param:
+        return var
+    if isinstance(expr, cp.Variable):
+        return cp.Parameter(expr.shape)
+    if not expr.args:
+        return expr
+    return expr.copy([_swap(arg, param, var) for arg in expr.args])
+
+
+def is_affine_in(expr, param):
+    """Check whether an expression is affine in a parameter
+    The variables of expr are held fixed, so dat@x is affine in dat
+    while cp.quad_over_lin(dat@x, lam) is not.
+    Parameters
+    ----------
+    expr: cvxpy expression
+        Expression to check
+    param: cvxpy Parameter
+        Parameter the expression should be affine in
+    Returns
+    -------
+    bool
+    """
+    return _swap(expr, param, cp.Variable(param.shape)).is_affine()
+
+
+def _entries(expr, variables):
+    """Return the entries of variables that a variable expression refers to"""
+    values = {id(var): var.value for var in variables}
+    offset = 0
+    try:
+        for var in variables:
+            var.value = offset + np.arange(var.size, dtype=float).reshape(var.shape)
+            offset += var.size
+        return set(np.ravel(expr.value).astype(int).tolist())
+    finally:
+        for var in variables:
+            var.value = values[id(var)]
+
+
+def affine_collapsible(problem, dat):
+    """Check whether an MRO problem is equivalent to its K = 1 instance
+    This holds when the data parameter dat only enters constraints built
+    by mro_constraints, each one affine in dat, with one row per cluster
+    sharing the data-free part, and when each entry of their epigraph
+    variables s is bounded by that single affine piece and otherwise only
+    appears in the weighted sum w@s of the same mro_constraints call. The
+    weighted sum of the epigraph variables then equals the loss at the
+    weighted mean of the clusters, see collapse_affine. Constraints
+    written by hand, or several pieces bounding the same epigraph
+    variable (e.g. a maximum of affine losses), are not collapsible.
+    Parameters
+    ----------
+    problem: cvxpy Problem
+        MRO problem
+    dat: cvxpy Parameter
+        Clustered data parameter, one row per cluster
+    Returns
+    -------
+    bool
+    """
+    if any(param is dat for param in problem.objective.parameters()):
+        return False
+    tagged = [constraint for constraint in problem.constraints
+              if getattr(constraint, "mro_role", (None, None))[1] is dat]
+    losses = [constraint for constraint in tagged if constraint.mro_role[0] == "loss"]
+    if not losses:
+        return False
+    for constraint in problem.constraints:
+        if any(param is dat for param in constraint.parameters()) and \
+                not any(constraint is loss for loss in losses):
+            return False
+    if not all(is_affine_in(loss.expr, dat) for loss in losses):
+        return False
+
+    epigraph = {id(var): var for loss in losses for var in loss.mro_role[2].variables()}
+    for expr in [problem.objective] + [constraint for constraint in problem.constraints
+                                       if not any(constraint is other for other in tagged)]:
+        if any(id(var) in epigraph for var in expr.variables()):
+            return False
+    covered = set()
+    for loss in losses:
+        entries = _entries(loss.mro_role[2], list(epigraph.values()))
+        if covered & entries:
+            return False
+        covered |= entries
+    return True
+
+
+def collapse_affine(d_train, wk):
+    """Reduce clustered data to its weighted mean
+    Only valid for problems where affine_collapsible holds. For cluster
+    means the result is the mean of the full dataset, for any K.
+    Parameters
+    ----------
+    d_train: array
+        Clustered data, K entries
+    wk: vector
+        Weights of the clusters
+    Returns
+    -------
+    d_train: array
+        Weighted mean of the clusters, 1 entry
+    wk: vector
+        Unit weight
+    """
+    return (np.asarray(wk) @ d_train / np.sum(wk))[None, :], np.ones(1)
+
+
+def tile_rows(expr, N):
+    """Stack N copies of a vector expression as the rows of a matrix
+    Parameters
+    ----------
+    expr: cvxpy expression
+        Vector expression of size m
+    N: int
+        Number of rows
+    Returns
+    -------
+    cvxpy expression of shape (N, m)
+    """
+    return np.ones((N, 1)) @ cp.reshape(expr, (1, expr.size), order="C")
+
+
+def mro_constraints(dat, w, eps, lam, s, const, coef, penalty=None, bound=0):
+    """Create the MRO constraints of a loss affine in the data
+    For the loss const + u@coef with Wasserstein ball radius eps around
+    the clustered data dat with weights w, the constraints are
+        eps*lam + w@s <= bound
+        const + dat@coef + penalty <= s
+        lam >= 0
+    where the second one is a single broadcast vector constraint over the
+    clusters, and the only upper bound on s the problem should have for
+    affine_collapsible to hold. The default penalty is the conjugate of the 2-Wasserstein
+    transport cost, cp.quad_over_lin(coef, 4*lam). The constraints are
+    DPP whenever const and coef are parameter-free.
+    Parameters
+    ----------
+    dat: cvxpy Parameter
+        Clustered data, shape (N, m)
+    w: cvxpy Parameter
+        Weights of the clusters, size N
+    eps: cvxpy Parameter
+        Radius of the Wasserstein ball
+    lam: cvxpy Variable
+        Dual variable of the Wasserstein ball
+    s: cvxpy Variable
+        Epigraph variables of the clusters, size N
+    const: cvxpy expression
+        Scalar part of the loss that does not depend on the data
+    coef: cvxpy expression
+        Coefficients of the data in the loss, size m
+    penalty: cvxpy expression
+        Scalar penalty of the worst-case data perturbation
+    bound: cvxpy expression
+        Upper bound on the worst-case expected loss
+    Returns
+    -------
+    constraints: list
+        List of cvxpy constraints
+    """
+    if penalty is None:
+        penalty = cp.quad_over_lin(coef, 4*lam)
+    constraints = [cp.multiply(eps, lam) + w@s <= bound]
+    constraints += [const + dat@coef + penalty <= s]
+    constraints += [lam >= 0]
+    # roles read by affine_collapsible
+    constraints[0].mro_role = ("ball", dat, s)
+    constraints[1].mro_role = ("loss", dat, s)
+    return constraints
+
+
+def second_moment_factor(d_train, wk):
+    """Return a square factor of the weighted second moment of the data
+    For losses quadratic in the data, the optimal dual variable of every
+    cluster is the same linear map applied to its data point, so that the
+    MRO problem only depends on the data through sum_k wk[k] d_k d_k^T.
+    The m columns of the factor can replace the K clusters, with unit
+    weights, for any K.
+    Parameters
+    ----------
+    d_train: array
+        Clustered data, K entries
+    wk: vector
+        Weights of the clusters
+    Returns
+    -------
+    L: array
+        Matrix of shape (m, m) with L @ L.T equal to the second moment
+    """
+    S = d_train.T @ (np.asarray(wk)[:, None] * d_train)
+    vals, vecs = np.linalg.eigh(S)
+    return vecs * np.sqrt(np.maximum(vals, 0))
@@ -0,0 +1,184 @@
+import os
+import inspect
+import marshal
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+import joblib
+import cvxpy as cp
+from mro.utils import _hash_update
+from mro import formulation
+
+_PROBLEMS = OrderedDict()
+_STORE_PATHS = {}
+
+
+def _code_hash(func):
+    """Hash of the source of a function, of its bytecode if unavailable"""
+    try:
+        code = inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        code = marshal.dumps(func.__code__)
+    return hashlib.sha256(code).hexdigest()
+
+
+def save_problem(path, out):
+    """Save the output of a problem builder with its compiled problem data
+    The parameter values and the solver interface are not saved, only
+    the problem, its variables and parameters, and the cvxpy cache holding
+    the sparse conic data templates and the parameter-to-coefficient maps.
+    The file is written atomically.
+    Parameters
+    ----------
+    path: str or Path
+        File to write
+    out: tuple
+        Output of the problem builder, the problem first
+    """
+    problem = out[0]
+    values = {param.id: param.value for param in problem.parameters()}
+    chain, solver_cache = problem._cache.solving_chain, problem._solver_cache
+    try:
+        for param in problem.parameters():
+            param.value = None
+        problem._cache.solving_chain, problem._solver_cache = None, {}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        joblib.dump(out, tmp)
+        os.replace(tmp, path)
+    finally:
+        for param in problem.parameters():
+            param.value = values[param.id]
+        problem._cache.solving_chain, problem._solver_cache = chain, solver_cache
+
+
+def load_problem(path, mmap_mode="r"):
+    """Load the output of a problem builder saved with save_problem
+    The compiled problem data are memory-mapped, so that workers sharing
+    a store only read the pages they use, and the solving chain is
+    rebuilt without canonicalizing the problem again.
+    Parameters
+    ----------
+    path: str or Path
+        File to read
+    mmap_mode: str
+        Memory-map mode of the numpy arrays, None to load them in memory
+    Returns
+    -------
+    out: tuple
+        Output of the problem builder, the problem first
+    """
+    out = joblib.load(path, mmap_mode=mmap_mode)
+    problem = out[0]
+    key = problem._cache.key
+    if key is not None:
+        problem._cache.solving_chain = problem._construct_chain(
+            solver=key[0], gp=key[1], ignore_dpp=key[2])
+        if hasattr(problem, "solver_context"):
+            problem.solver_context = problem._cache.solving_chain.solver_context
+    return out
+
+
+def cached_problem(prob, *args, solver=None, maxsize=32, store_dir=None):
+    """Return prob(*args), reusing the instance built earlier in this process
+    Problems are keyed by the builder, its arguments (the problem sizes,
+    hashed by content for arrays and dicts) and the solver, and the least
+    recently used ones are dropped beyond maxsize. A cached problem keeps
+    its cvxpy compilation, so for DPP problems later solves only swap the
+    Parameter values. The caller sets all Parameter values after each call.
+    With a store directory (store_dir, or the MRO_PROBLEM_STORE environment
+    variable), problems missing in memory are loaded from disk if a worker
+    saved them before, and compile_problem saves the ones it compiles.
+    Stored problems are also keyed by the source of the builder and of
+    mro.formulation.mro_constraints, so that editing them recompiles.
+    Parameters
+    ----------
+    prob: function
+        Problem builder
+    args: tuple
+        Arguments of the problem builder
+    solver: str
+        Solver the problem is compiled for
+    maxsize: int
+        Maximum number of cached problems
+    store_dir: str or Path
+        Directory of compiled problems shared between processes
+    Returns
+    -------
+    The output of prob(*args)
+    """
+    h = hashlib.sha256()
+    _hash_update(h, (prob.__module__, prob.__qualname__, args, solver))
+    key = h.hexdigest()
+    if key in _PROBLEMS:
+        _PROBLEMS.move_to_end(key)
+        return _PROBLEMS[key]
+
+    if store_dir is None:
+        store_dir = os.environ.get("MRO_PROBLEM_STORE")
+    path = None
+    if store_dir:
+        # edits of the builder or of the shared constraints change the file
+        _hash_update(h, (_code_hash(prob), _code_hash(formulation.mro_constraints)))
+        path = Path(store_dir) / ("%s_%s.joblib" % (h.hexdigest(), cp.__version__))
+    if path is not None and path.exists():
+        _PROBLEMS[key] = load_problem(path)
+    else:
+        _PROBLEMS[key] = prob(*args)
+        if path is not None:
+            _STORE_PATHS[id(_PROBLEMS[key][0])] = (key, path)
+    while len(_PROBLEMS) > maxsize:
+        _, out = _PROBLEMS.popitem(last=False)
+        _STORE_PATHS.pop(id(out[0]), None)
+    return _PROBLEMS[key]
+
+
+def compile_problem(problem, solver=None, **kwargs):
+    """Canonicalize a DPP problem for solver ahead of its first solve
+    cvxpy keeps the result and reuses it for every following solve with
+    the same solver, so that the compile time is paid once, at setup.
+    Problems from cached_problem with a store directory are saved there.
+    Parameter values must be set. Problems that are not DPP are
+    canonicalized at each solve and are left untouched.
+    Parameters
+    ----------
+    problem: cvxpy Problem
+        Problem to compile
+    solver: str
+        Solver passed to problem.solve
+    kwargs: dict
+        Additional arguments of problem.get_problem_data
+    """
+    if problem.is_dpp():
+        problem.get_problem_data(solver, **kwargs)
+        if id(problem) in _STORE_PATHS:
+            key, path = _STORE_PATHS.pop(id(problem))
+            save_problem(path, _PROBLEMS[key])
+
+
+def solve_eps_path(problem, eps_pm, eps_nums, **kwargs):
+    """Solve a problem for consecutive values of epsilon with warm starts
+    Every solve after the first one starts from the solution of the
+    previous epsilon, kept in the variable values. Conic solvers that
+    support it use it as initial iterate, and mixed-integer solvers use
+    the previous boolean variables as a MIP start.
+    Parameters
+    ----------
+    problem: cvxpy Problem
+        Problem to solve
+    eps_pm: cvxpy Parameter
+        Epsilon parameter of the problem
+    eps_nums: vector
+        Epsilon values, in the order they are solved
+    kwargs: dict
+        Additional arguments of problem.solve
+    Returns
+    -------
+    generator
+        (eps_count, eps, iters) after each solve, where iters is the number
+        of solver iterations reported for that solve
+    """
+    for eps_count, eps in enumerate(eps_nums):
+        eps_pm.value = eps
+        problem.solve(warm_start=True, **kwargs)
+        yield eps_count, eps, problem.solver_stats.num_iters
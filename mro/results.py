@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+
+
+def _empty(n_rows, dtype):
+    """Preallocated column, missing values being nan for floats"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return np.full(n_rows, np.nan, dtype=dtype)
+    return np.zeros(n_rows, dtype=dtype)
+
+
+class ResultRecorder:
+    """Typed columns of experiment results, preallocated for the grid
+    Rows are filled in order with append, and columns computed after the
+    solves can be set at once, e.g. recorder["Eval_val"] = values. The
+    recorded rows are returned as NumPy buffers, to be turned into a
+    dataframe or an Arrow table once all results are gathered.
+    Parameters
+    ----------
+    n_rows: int
+        Maximum number of rows, e.g. len(K_nums)*len(eps_nums)
+    columns: dict
+        Column names and dtypes
+    """
+
+    def __init__(self, n_rows, columns):
+        self.n = 0
+        self.n_rows = n_rows
+        self.columns = {name: _empty(n_rows, dtype) for name, dtype in columns.items()}
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.n]
+
+    def __setitem__(self, name, values):
+        values = np.ravel(values)
+        if name not in self.columns:
+            self.columns[name] = _empty(self.n_rows, values.dtype)
+        self.columns[name][:len(values)] = values
+
+    def append(self, row):
+        """Record the next row
+        Parameters
+        ----------
+        row: dict
+            Values of some of the columns, None for missing values
+        """
+        for name, val in row.items():
+            self.columns[name][self.n] = np.nan if val is None else val
+        self.n += 1
+
+    def select(self, mask):
+        """Return the recorded rows where mask holds, as a dict of arrays"""
+        return {name: col[:self.n][mask] for name, col in self.columns.items()}
+
+    def buffers(self):
+        """Return the recorded rows as a dict of arrays"""
+        return {name: col[:self.n] for name, col in self.columns.items()}
+
+
+def to_frame(buffers):
+    """Turn recorded buffers into a dataframe
+    Parameters
+    ----------
+    buffers: dict
+        Output of ResultRecorder.buffers
+    Returns
+    -------
+    dataframe
+        One column per buffer
+    """
+    return pd.DataFrame(buffers)
+
+
+def to_arrow(buffers):
+    """Turn recorded buffers into an Arrow table, requires pyarrow
+    Parameters
+    ----------
+    buffers: dict
+        Output of ResultRecorder.buffers
+    Returns
+    -------
+    pyarrow.Table
+        One column per buffer
+    """
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError("to_arrow requires pyarrow") from e
+    return pa.table(buffers)
+
+
+class P2Quantile:
+    """Streaming estimate of a quantile with the P-square algorithm
+    The first observations are kept, and the quantile is exact, up to
+    exact observations, as P-square is inaccurate on few observations.
+    Beyond, the P-square markers are started from the kept observations
+    and they are dropped: five markers remain, whose heights are adjusted
+    with piecewise parabolic interpolation as observations arrive, so that
+    the memory does not grow with the number of observations.
+    Parameters
+    ----------
+    p: float
+        Quantile level in (0, 1)
+    exact: int
+        Number of observations up to which the quantile is exact, at
+        least 5
+    """
+
+    def __init__(self, p, exact=500):
+        self.p = p
+        self.exact = max(exact, 5)
+        self.values = []
+        self.heights = None
+        self.incr = np.array([0, p/2, p, (1 + p)/2, 1])
+
+    def _start(self):
+        """Place the markers on the kept observations, and drop them"""
+        values = np.sort(self.values)
+        n = len(values)
+        self.desired = (n - 1)*self.incr
+        pos = np.round(self.desired)
+        for i in (1, 2, 3):
+            pos[i] = min(max(pos[i], pos[i - 1] + 1), n - 5 + i)
+        self.pos = pos
+        self.heights = list(values[pos.astype(int)])
+        self.values = None
+
+    def update(self, x):
+        """Add an observation"""
+        if self.values is not None:
+            self.values.append(x)
+            if len(self.values) > self.exact:
+                self._start()
+            return
+        q = self.heights
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = int(np.searchsorted(q, x, side="right")) - 1
+        n = self.pos
+        n[k + 1:] += 1
+        self.desired += self.incr
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = np.sign(d)
+                qp = q[i] + d/(n[i + 1] - n[i - 1])*(
+                    (n[i] - n[i - 1] + d)*(q[i + 1] - q[i])/(n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d)*(q[i] - q[i - 1])/(n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    j = i + int(d)
+                    qp = q[i] + d*(q[j] - q[i])/(n[j] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        """Return the current estimate, exact for at most exact observations"""
+        if self.values is not None:
+            return np.quantile(self.values, self.p) if self.values else np.nan
+        return self.heights[2]
+
+
+class ResultAggregator:
+    """Streaming statistics of results over replicates, by (K, Epsilon)
+    Results are merged as they arrive with Welford's algorithm for the
+    mean and variance, and P2Quantile for the quantiles, exact for the
+    usual number of replicates, so that the memory does not grow with the
+    number of replicates. Boolean columns, e.g. satisfaction indicators,
+    get no quantiles.
+    Parameters
+    ----------
+    columns: list
+        Columns to aggregate, all numeric and boolean columns by default
+    quantiles: tuple
+        Quantile levels
+    keys: tuple
+        Columns identifying a point of the grid
+    """
+
+    def __init__(self, columns=None, quantiles=(0.1, 0.5, 0.9), keys=("K", "Epsilon")):
+        self.columns = columns
+        self.quantiles = quantiles
+        self.keys = keys
+        self.stats = {}
+
+    def update(self, buffers):
+        """Merge the results of one replicate or task
+        Parameters
+        ----------
+        buffers: dict or dataframe
+            Results, see ResultRecorder.buffers
+        """
+        columns = self.columns
+        if columns is None:
+            columns = [name for name in buffers if name not in self.keys + ("r",)
+                       and np.asarray(buffers[name]).dtype.kind in "biuf"]
+        keys = list(zip(*[np.asarray(buffers[key]).tolist() for key in self.keys]))
+        values = {name: np.asarray(buffers[name], dtype=float) for name in columns}
+        quantiles = {name: () if np.asarray(buffers[name]).dtype.kind == "b" else self.quantiles
+                     for name in columns}
+        for row, key in enumerate(keys):
+            point = self.stats.setdefault(key, {})
+            for name in columns:
+                x = values[name][row]
+                if np.isnan(x):
+                    continue
+                if name not in point:
+                    point[name] = [0, 0., 0., [P2Quantile(p) for p in quantiles[name]]]
+                stat = point[name]
+                stat[0] += 1
+                delta = x - stat[1]
+                stat[1] += delta/stat[0]
+                stat[2] += delta*(x - stat[1])
+                for est in stat[3]:
+                    est.update(x)
+
+    def to_frame(self):
+        """Return the statistics, one row per (K, Epsilon)
+        Returns
+        -------
+        dataframe
+            Columns with the mean of each result under its own name, its
+            standard deviation with suffix _std, its quantiles with
+            suffix _q followed by the level in percent, and the largest
+            number of replicates in count
+        """
+        rows = []
+        for key in sorted(self.stats):
+            row = dict(zip(self.keys, key))
+            row["count"] = max(stat[0] for stat in self.stats[key].values())
+            for name, (n, mean, M2, ests) in self.stats[key].items():
+                row[name] = mean
+                row[name + "_std"] = np.sqrt(M2/(n - 1)) if n > 1 else np.nan
+                for est in ests:
+                    row["%s_q%g" % (name, 100*est.p)] = est.value()
+            rows.append(row)
+        return pd.DataFrame(rows)
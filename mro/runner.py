@@ -0,0 +1,454 @@
+import argparse
+import importlib.util
+import json
+import shutil
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from mro.store import (config_key, task_key, write_manifest, completed_tasks,
+                       save_result, load_result, SolutionStore)
+from mro.schedule import fit_runtime, predict_runtime, lpt_order, lpt_makespan
+from mro.search import adaptive_eps, adaptive_K
+from mro.results import to_frame, ResultAggregator
+from mro.datasets import DatasetRegistry, resolve
+from mro.utils import get_n_processes
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Experiment families, each a script defining setup(config) and
+# run_task(data, r, K_nums, eps_nums)
+FAMILIES = {
+    "portcont": "portfolio/cont/portcont.py",
+    "portMIP": "portfolio/MIP/portMIP.py",
+    "newscont": "newsvendor/cont/newscont.py",
+    "newsMIP": "newsvendor/MIP/newsMIP.py",
+    "facility": "facility/facility.py",
+    "logsumexp": "logsumexp/logsumexp.py",
+    "quadratic": "quadratic_concave/quadratic.py",
+}
+
+
+def load_family(family):
+    """Import the script of an experiment family, once per process
+    Parameters
+    ----------
+    family: str
+        Key of FAMILIES, or path of a script with the same functions
+    Returns
+    -------
+    module
+        The imported script
+    """
+    path = ROOT / FAMILIES.get(family, family)
+    name = "mro_family_" + path.stem
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+def eps_grid(spec):
+    """Return the epsilons of a config
+    Parameters
+    ----------
+    spec: list or dict
+        List of epsilons, or {"logspace": [start, stop, num]}, or
+        {"linspace": [start, stop, num]}
+    Returns
+    -------
+    vector
+        Epsilons
+    """
+    if isinstance(spec, dict):
+        (kind, args), = spec.items()
+        return getattr(np, kind)(*args)
+    return np.asarray(spec, dtype=float)
+
+
+def make_tasks(R, n_K, n_eps, eps_block=None, all_K=False):
+    """Expand the experiment grid into independent tasks
+    Parameters
+    ----------
+    R: int
+        Number of replicates
+    n_K: int
+        Number of K values
+    n_eps: int
+        Number of epsilons
+    eps_block: int
+        Number of consecutive epsilons per task, all of them by default
+    all_K: bool
+        Whether each task solves every K, see search_K
+    Returns
+    -------
+    list
+        Tasks (r, K index, epsilon indices), with the vector of all K
+        indices if all_K
+    """
+    eps_block = n_eps if eps_block is None else eps_block
+    K_counts = [np.arange(n_K)] if all_K else range(n_K)
+    return [(r, K_count, np.arange(start, min(start + eps_block, n_eps)))
+            for r in range(R)
+            for K_count in K_counts
+            for start in range(0, n_eps, eps_block)]
+
+
+def write_solutions(solutions, task_sols, r, K_count, inds, n_K, n_eps, R):
+    """Write the optimal solutions of a task in its slice of the shared tensors
+    Parameters
+    ----------
+    solutions: mro.store.SolutionStore
+        Store of the tensors, with shape (n_K, n_eps, ..., R)
+    task_sols: dict
+        Optimal solutions of the task, see run_task
+    r: int
+        Replicate
+    K_count: int or vector
+        Index of K, or indices of the K of a search_K task
+    inds: vector
+        Indices of the epsilons
+    n_K: int
+        Number of K values
+    n_eps: int
+        Number of epsilons
+    R: int
+        Number of replicates
+    """
+    for name, val in task_sols.items():
+        solutions.write(name, _slot(K_count, inds, val, r), val,
+                        shape=(n_K, n_eps) + val.shape[2:] + (R,))
+
+
+def _slot(K_count, inds, val, r):
+    """Index of the solutions val of a task in the tensor of all solutions,
+    a search filling the first K or epsilon slots only"""
+    return (np.atleast_1d(K_count)[:val.shape[0], None], inds[None, :val.shape[1]],
+            Ellipsis, r)
+
+
+def search_eps(family, data, r, K, search):
+    """Solve one replicate and one K on an adaptive epsilon grid
+    Each epsilon is solved with the run_task function of the family, see
+    mro.search.adaptive_eps. The clustering of the replicate is kept in
+    memory between the solves, see mro.utils.disk_cached, and so are the
+    compiled problems, see mro.problems.cached_problem.
+    Parameters
+    ----------
+    family: str
+        Key of FAMILIES, or path of a script
+    data: dict
+        Output of the setup function of the family
+    r: int
+        Replicate
+    K: int
+        Number of clusters
+    search: dict
+        Keyword arguments of adaptive_eps, with "eps_min" and "eps_max",
+        and optionally "satisfy", the column of the results holding the
+        satisfaction indicator ("satisfy" by default)
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the epsilons solved in increasing
+        order on the second axis
+    df: dataframe
+        The results, one row per epsilon solved, with the calibrated
+        epsilon in column "eps_target", nan if there is none
+    """
+    search = dict(search)
+    column = search.pop("satisfy", "satisfy")
+    module = load_family(family)
+    solved = {}
+
+    def solve(eps):
+        solved[eps] = module.run_task(data, r, np.array([K]), np.array([eps]))
+        res = {name: np.asarray(val)[0] for name, val in solved[eps][1].items()}
+        res["satisfy"] = res[column]
+        return res
+
+    results, eps_target = adaptive_eps(solve, **search)
+    eps_solved = [eps for eps, _ in results]
+    sols = {name: np.concatenate([solved[eps][0][name] for eps in eps_solved], axis=1)
+            for name in solved[eps_solved[0]][0]}
+    df = pd.concat([to_frame(solved[eps][1]) for eps in eps_solved], ignore_index=True)
+    df["eps_target"] = np.nan if eps_target is None else eps_target
+    return sols, df
+
+
+def search_K(family, data, r, K_nums, eps_nums, tol):
+    """Solve one replicate for increasing K until the results are within tol
+    Each K is solved with the run_task function of the family, and the
+    larger K are neither clustered nor solved once the clustering bound
+    or the change in objective is within tol, see mro.search.adaptive_K.
+    Parameters
+    ----------
+    family: str
+        Key of FAMILIES, or path of a script
+    data: dict
+        Output of the setup function of the family
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters, in increasing order
+    eps_nums: vector
+        Epsilons
+    tol: float
+        Tolerance of adaptive_K
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K solved on the first axis
+    df: dataframe
+        The results, for the K solved
+    """
+    module = load_family(family)
+    solved = {}
+
+    def solve(K):
+        solved[K] = module.run_task(data, r, np.array([K]), eps_nums)
+        return to_frame(solved[K][1])
+
+    results, _ = adaptive_K(solve, K_nums, tol)
+    K_solved = [K for K, _ in results]
+    sols = {name: np.concatenate([solved[K][0][name] for K in K_solved], axis=0)
+            for name in solved[K_solved[0]][0]}
+    df = pd.concat([res for _, res in results], ignore_index=True)
+    return sols, df
+
+
+def _run_task(family, data, r, K, eps_nums, store=None, solutions=None, slot=None,
+              search=None, K_tol=None):
+    """Run one task in a worker, on the data of setup with its shared arrays
+    resolved, on the epsilons eps_nums or searching them with search_eps
+    if search is given. With K_tol, K is the vector of all K, searched
+    with search_K. With a store, the result is saved there instead of
+    returned. With solutions, the optimal solutions are written in the
+    shared tensors, slot holding the remaining arguments of
+    write_solutions, and left out of the result.
+    """
+    if K_tol is not None:
+        task_sols, df = search_K(family, resolve(data), r, K, eps_nums, K_tol)
+    elif search is None:
+        task_sols, df = load_family(family).run_task(resolve(data), r, np.array([K]), eps_nums)
+    else:
+        task_sols, df = search_eps(family, resolve(data), r, K, search)
+    if solutions is not None:
+        write_solutions(solutions, task_sols, r, *slot)
+        task_sols = {}
+    if store is None:
+        return task_sols, df
+    save_result(store, task_key(r, K, eps_nums), (task_sols, df))
+
+
+def load_history(paths, family, m=None):
+    """Load the recorded results of previous runs of a family
+    Parameters
+    ----------
+    paths: list
+        Paths of df_all.csv files written by save
+    family: str
+        Family of the runs to keep
+    m: int
+        Size of the data samples of the runs to keep, all by default
+    Returns
+    -------
+    dataframe
+        Recorded results, None if there are none
+    """
+    dfs = [pd.read_csv(path) for path in paths]
+    if not dfs:
+        return None
+    df = pd.concat(dfs, ignore_index=True)
+    if "family" in df:
+        df = df[df["family"] == family]
+    if m is not None and "m" in df and (df["m"] == m).any():
+        df = df[df["m"] == m]
+    return df if len(df) else None
+
+
+def task_costs(tasks, K_nums, model, m=None):
+    """Predict the duration of each task, see predict_runtime, a search_K
+    task counting all its K"""
+    return np.array([sum(predict_runtime(model, K, len(inds), m)
+                         for K in np.atleast_1d(K_nums[K_count]))
+                     for _, K_count, inds in tasks])
+
+
+def collect(tasks, results, n_K, n_eps, R):
+    """Assemble the results of the tasks
+    Parameters
+    ----------
+    tasks: list
+        Tasks, see make_tasks
+    results: list
+        Outputs of run_task, in the order of the tasks
+    n_K: int
+        Number of K values
+    n_eps: int
+        Number of epsilons
+    R: int
+        Number of replicates
+    Returns
+    -------
+    sols: dict
+        Optimal solutions, with shape (n_K, n_eps, ..., R), zero where
+        a task solved fewer K or epsilons than its indices
+    df: dataframe
+        The results of all tasks, with the replicate in column "r"
+    """
+    sols = {}
+    dfs = []
+    for (r, K_count, inds), (task_sols, buffers) in zip(tasks, results):
+        for name, val in task_sols.items():
+            if name not in sols:
+                sols[name] = np.zeros((n_K, n_eps) + val.shape[2:] + (R,))
+            sols[name][_slot(K_count, inds, val, r)] = val
+        dfs.append(to_frame(buffers).assign(r=r))
+    df = pd.concat(dfs, ignore_index=True)
+    return sols, df.sort_values(["r", "K", "Epsilon"], ignore_index=True)
+
+
+def run(config, n_jobs=None):
+    """Run the tasks of an experiment config on all available cores
+    Parameters
+    ----------
+    config: dict
+        Config with "family", "K_nums", "eps_nums" (see eps_grid), "R",
+        optionally "eps_block", "n_jobs", "history" (paths of the
+        results of previous runs, used to dispatch the longest tasks
+        first) and "output" (folder where each task saves its result as
+        soon as it is done, and where a rerun of the same config skips
+        the tasks already done), and the entries read by the setup
+        function of the family. With "output", the tasks write the
+        optimal solutions in memory-mapped tensors of the store, with the
+        data type and sparse encoding given by the optional "solutions"
+        entry, see mro.store.SolutionStore. With "eps_search", the
+        keyword arguments of search_eps, each task searches the epsilons
+        of one replicate and K instead of solving "eps_nums", and the
+        epsilon axis of the solutions holds the solves in increasing
+        order of epsilon, up to "max_solves" (30 by default). With
+        "K_tol", each task solves the K of one replicate in increasing
+        order until the results are within K_tol, see search_K, and the
+        K not solved are missing from the results, zero in the solutions.
+        "clustering" holds the keyword arguments of mro.utils.cluster_path
+        used by every family, e.g. {"method": "stream", "chunk_size":
+        100000} for datasets too large for a full KMeans
+    n_jobs: int
+        Number of processes, overrides the config
+    Returns
+    -------
+    sols: dict
+        Optimal solutions, see collect
+    df: dataframe
+        The results of all tasks, see collect
+    """
+    family = config["family"]
+    K_nums = np.asarray(config["K_nums"])
+    R = config["R"]
+    search = config.get("eps_search")
+    K_tol = config.get("K_tol")
+    if K_tol is not None and search is not None:
+        raise ValueError("K_tol and eps_search cannot be combined")
+    if K_tol is not None:
+        K_nums = np.sort(K_nums)
+    if search is None:
+        eps_nums = eps_grid(config["eps_nums"])
+        tasks = make_tasks(R, len(K_nums), len(eps_nums), config.get("eps_block"),
+                           all_K=K_tol is not None)
+    else:
+        # slots of the epsilons solved by each search
+        eps_nums = np.arange(search.get("max_solves", 30), dtype=float)
+        tasks = make_tasks(R, len(K_nums), len(eps_nums))
+    data = load_family(family).setup(config)
+    keys = [task_key(r, K_nums[K_count], eps_nums[inds]) for r, K_count, inds in tasks]
+    store = solutions = None
+    todo = list(range(len(tasks)))
+    if "output" in config:
+        store = Path(config["output"]) / "tasks" / config_key(config)
+        solutions = SolutionStore(store / "solutions", **config.get("solutions", {}))
+        write_manifest(store, config, {key: (r, K_nums[K_count], eps_nums[inds])
+                                       for key, (r, K_count, inds) in zip(keys, tasks)})
+        done = completed_tasks(store)
+        if not done:
+            # solutions left by a run that saved no result
+            solutions.clear()
+        todo = [ind for ind, key in enumerate(keys) if key not in done]
+        print("%d of %d tasks already done" % (len(tasks) - len(todo), len(tasks)))
+    if n_jobs is None:
+        n_jobs = get_n_processes(config.get("n_jobs", np.inf))
+    history = load_history(config.get("history", []), family, config.get("m"))
+    model = None if history is None else fit_runtime(history)
+    costs = task_costs([tasks[ind] for ind in todo], K_nums, model, config.get("m"))
+    todo = [todo[ind] for ind in lpt_order(costs)]
+    print("%d tasks, predicted makespan %.1f on %d processes"
+          % (len(todo), lpt_makespan(costs, n_jobs), n_jobs))
+    # large inputs are written once and read by the workers in place
+    with DatasetRegistry() as registry:
+        shared = registry.share(data)
+        results = Parallel(n_jobs=n_jobs, batch_size=1)(
+            delayed(_run_task)(family, shared, tasks[ind][0], K_nums[tasks[ind][1]],
+                               eps_nums[tasks[ind][2]], store, solutions,
+                               (tasks[ind][1], tasks[ind][2], len(K_nums), len(eps_nums), R),
+                               search, K_tol)
+            for ind in todo)
+    if store is None:
+        tasks = [tasks[ind] for ind in todo]
+    else:
+        results = [load_result(store, key) for key in keys]
+    sols, df = collect(tasks, results, len(K_nums), len(eps_nums), R)
+    if solutions is not None:
+        sols.update({name: solutions.load(name) for name in solutions.names()})
+    df["family"] = family
+    if "m" in config:
+        df["m"] = config["m"]
+    return sols, df
+
+
+def save(folder, sols, df):
+    """Save the solutions, the results of every replicate, and their statistics
+    Parameters
+    ----------
+    folder: str
+        Output folder
+    sols: dict
+        Optimal solutions, see collect
+    df: dataframe
+        The results of all tasks, see collect
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for name, val in sols.items():
+        path = folder / (name + ".npy")
+        if isinstance(val, np.memmap):
+            # already on disk, copied without loading it
+            if Path(val.filename).resolve() != path.resolve():
+                shutil.copyfile(val.filename, path)
+        else:
+            np.save(path, val)
+    df.to_csv(folder / "df_all.csv")
+    agg = ResultAggregator()
+    agg.update(df.drop(columns=["m"], errors="ignore"))
+    agg.to_frame().to_csv(folder / "df.csv")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run an experiment family from a JSON config")
+    parser.add_argument("config", help="path to the JSON config")
+    parser.add_argument("--n_jobs", type=int, help="number of processes")
+    args = parser.parse_args(argv)
+    with open(args.config) as f:
+        config = json.load(f)
+    if "output" not in config:
+        # checked before running, as the results are only saved at the end
+        parser.error("the config has no \"output\" folder to save the results in")
+    sols, df = run(config, args.n_jobs)
+    save(config["output"], sols, df)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import heapq
+import numpy as np
+
+TIME_COLUMNS = ("solvetime", "setuptime", "clustertime")
+
+
+def _design(K, m, features):
+    """Regressors of the runtime model"""
+    cols = [np.ones_like(K), np.log(K)]
+    if "m" in features:
+        cols.append(np.log(m))
+    return np.column_stack(cols)
+
+
+def fit_runtime(df):
+    """Fit log-linear models of the recorded times against K and m
+    Each time column present in df is modeled as
+    log(time) = a + b log(K) (+ c log(m) if m varies in df).
+    Parameters
+    ----------
+    df: dataframe
+        Recorded results, with "K" and optionally "m" and the columns of
+        TIME_COLUMNS
+    Returns
+    -------
+    dict
+        Coefficients of each time column, and the features used
+    """
+    K = df["K"].to_numpy(dtype=float)
+    features = ["K"]
+    m = None
+    if "m" in df and df["m"].nunique() > 1:
+        features.append("m")
+        m = df["m"].to_numpy(dtype=float)
+    X = _design(K, m, features)
+    model = {"features": features}
+    for col in TIME_COLUMNS:
+        if col not in df:
+            continue
+        t = df[col].to_numpy(dtype=float)
+        ok = np.isfinite(t)
+        if ok.sum() < X.shape[1]:
+            continue
+        model[col] = np.linalg.lstsq(
+            X[ok], np.log(np.maximum(t[ok], 1e-6)), rcond=None)[0]
+    return model
+
+
+def predict_runtime(model, K, n_eps, m=None):
+    """Predict the duration of a task
+    A task solves n_eps epsilons for one K, after building the problem
+    and clustering the data once. Without fitted times, the duration is
+    taken proportional to K*n_eps.
+    Parameters
+    ----------
+    model: dict
+        Output of fit_runtime, None if there is no recorded run
+    K: int
+        Number of clusters
+    n_eps: int
+        Number of epsilons
+    m: int
+        Size of each data sample
+    Returns
+    -------
+    float
+        Predicted duration in seconds
+    """
+    if model is None or not any(col in model for col in TIME_COLUMNS):
+        return float(K*n_eps)
+    x = _design(np.array([K], dtype=float), np.array([m], dtype=float),
+                model["features"])[0]
+    counts = {"solvetime": n_eps, "setuptime": 1, "clustertime": 1}
+    return float(sum(counts[col]*np.exp(x @ model[col])
+                     for col in TIME_COLUMNS if col in model))
+
+
+def lpt_order(costs):
+    """Return the task indices by decreasing predicted duration"""
+    return np.argsort(-np.asarray(costs), kind="stable")
+
+
+def lpt_makespan(costs, n_jobs):
+    """Makespan of the longest-first schedule on n_jobs processes
+    Parameters
+    ----------
+    costs: vector
+        Predicted durations of the tasks
+    n_jobs: int
+        Number of processes
+    Returns
+    -------
+    float
+        Time at which the last process finishes
+    """
+    loads = [0.]*n_jobs
+    for cost in np.sort(costs)[::-1]:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
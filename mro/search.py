@@ -0,0 +1,140 @@
+import numpy as np
+
+
+def _change(res_lo, res_hi):
+    """Change of the satisfaction and relative change of the objective"""
+    sat = abs(float(res_hi["satisfy"]) - float(res_lo["satisfy"]))
+    scale = max(abs(res_lo["Opt_val"]), abs(res_hi["Opt_val"]), 1e-8)
+    return max(sat, abs(res_hi["Opt_val"] - res_lo["Opt_val"]) / scale)
+
+
+def calibrated_eps(results, target):
+    """Return the smallest epsilon reaching a target satisfaction
+    Parameters
+    ----------
+    results: list
+        List of (eps, result) tuples sorted by eps, see adaptive_eps
+    target: float
+        Target satisfaction level
+    Returns
+    -------
+    float
+        Smallest eps with result["satisfy"] >= target, None if none does
+    """
+    for eps, res in results:
+        if res["satisfy"] >= target:
+            return eps
+    return None
+
+
+def adaptive_eps(solve, eps_min, eps_max, n_init=5, tol=0.05, target=None,
+                 max_solves=30, min_ratio=1.05):
+    """Solve on an epsilon grid refined where the results change quickly
+    Starts from n_init log-spaced values in [eps_min, eps_max], then
+    repeatedly bisects, at the geometric mean, the interval over which
+    the satisfaction or the relative objective changes the most, until
+    no interval changes by more than tol, intervals are narrower than a
+    factor min_ratio, or max_solves solves are done. With a target
+    satisfaction level, only the interval where the satisfaction crosses
+    the target is refined, and the search stops once it is narrower than
+    a factor min_ratio.
+    Parameters
+    ----------
+    solve: function
+        Maps eps to a dict with at least "satisfy" (an indicator, or its
+        average over replicates) and "Opt_val"
+    eps_min: float
+        Minimum epsilon
+    eps_max: float
+        Maximum epsilon
+    n_init: int
+        Size of the initial grid
+    tol: float
+        Largest change accepted between consecutive epsilons
+    target: float
+        Target satisfaction level
+    max_solves: int
+        Maximum number of calls to solve
+    min_ratio: float
+        Smallest ratio between consecutive epsilons
+    Returns
+    -------
+    results: list
+        List of (eps, result) tuples sorted by eps
+    eps_target: float
+        Calibrated epsilon, see calibrated_eps, None without target
+    """
+    results = [(eps, solve(eps))
+               for eps in np.logspace(np.log10(eps_min), np.log10(eps_max), n_init)]
+    while len(results) < max_solves:
+        candidates = []
+        for ind in range(len(results) - 1):
+            (eps_lo, res_lo), (eps_hi, res_hi) = results[ind], results[ind + 1]
+            if eps_hi / eps_lo < min_ratio:
+                continue
+            if target is None:
+                change = _change(res_lo, res_hi)
+                if change > tol:
+                    candidates.append((change, ind))
+            elif res_lo["satisfy"] < target <= res_hi["satisfy"]:
+                candidates.append((1., ind))
+        if not candidates:
+            break
+        _, ind = max(candidates)
+        eps = np.sqrt(results[ind][0] * results[ind + 1][0])
+        results.insert(ind + 1, (eps, solve(eps)))
+
+    eps_target = None if target is None else calibrated_eps(results, target)
+    return results, eps_target
+
+
+def K_converged(res, res_prev, tol):
+    """Check whether increasing the number of clusters is unnecessary
+    Parameters
+    ----------
+    res: dict or dataframe
+        Results for the current K, with "Opt_val" and optionally "bound",
+        either scalars or one value per epsilon
+    res_prev: dict or dataframe
+        Results for the previous K, None for the first one
+    tol: float
+        Tolerance on the clustering bound and on the change in objective
+    Returns
+    -------
+    bool
+        True if the bound or the change in objective is within tol
+    """
+    if "bound" in res and np.max(np.asarray(res["bound"])) <= tol:
+        return True
+    if res_prev is None:
+        return False
+    change = np.asarray(res["Opt_val"]) - np.asarray(res_prev["Opt_val"])
+    return np.max(np.abs(change)) <= tol
+
+
+def adaptive_K(solve, K_nums, tol):
+    """Solve for increasing K until the results are within tolerance
+    Parameters
+    ----------
+    solve: function
+        Maps K to the results for K, see K_converged
+    K_nums: vector
+        Candidate numbers of clusters
+    tol: float
+        Tolerance on the clustering bound and on the change in objective
+    Returns
+    -------
+    results: list
+        List of (K, result) tuples for the K solved, in increasing order
+    K: int
+        Smallest K within tolerance, the largest K solved otherwise
+    """
+    results = []
+    res_prev = None
+    for K in np.sort(K_nums):
+        res = solve(K)
+        results.append((K, res))
+        if K_converged(res, res_prev, tol):
+            break
+        res_prev = res
+    return results, results[-1][0]
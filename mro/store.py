@@ -0,0 +1,230 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+import joblib
+import numpy as np
+
+# Config entries that do not change the results of the tasks
+RUN_KEYS = ("n_jobs", "history", "output")
+
+
+def config_key(config):
+    """Return a fingerprint of the entries of a config defining the results
+    Parameters
+    ----------
+    config: dict
+        Runner config
+    Returns
+    -------
+    str
+        Hexadecimal key
+    """
+    entries = {key: val for key, val in config.items() if key not in RUN_KEYS}
+    return hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def task_key(r, K, eps_nums):
+    """Return the file name of a task, from its replicate, K (or vector of
+    K) and epsilons"""
+    eps_hash = hashlib.sha256(np.asarray(eps_nums, dtype=float).tobytes()).hexdigest()
+    return "r%d_K%s_%s" % (r, "-".join(str(int(val)) for val in np.atleast_1d(K)),
+                           eps_hash[:12])
+
+
+def _atomic_write(path, write):
+    """Write a file through a temporary file unique to the process"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def write_manifest(folder, config, tasks):
+    """Write the config and the list of tasks of a store
+    Parameters
+    ----------
+    folder: str or Path
+        Folder of the store
+    config: dict
+        Runner config
+    tasks: dict
+        Keys of the tasks, see task_key, mapped to (r, K or vector of K,
+        epsilons)
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    manifest = {"config": {key: val for key, val in config.items() if key not in RUN_KEYS},
+                "tasks": {key: {"r": int(r), "K": np.asarray(K).tolist(), "eps_nums": list(map(float, eps))}
+                          for key, (r, K, eps) in tasks.items()}}
+
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1)
+    _atomic_write(folder / "manifest.json", write)
+
+
+def completed_tasks(folder):
+    """Return the keys of the tasks with a saved result"""
+    folder = Path(folder)
+    if not folder.is_dir():
+        return set()
+    return {path.stem for path in folder.glob("*.joblib")}
+
+
+def save_result(folder, key, result):
+    """Save the result of a task, unless it is already saved
+    The file is written atomically, so that concurrent workers and
+    interrupted runs never leave a partial result.
+    Parameters
+    ----------
+    folder: str or Path
+        Folder of the store
+    key: str
+        Key of the task, see task_key
+    result: object
+        Output of the task
+    """
+    path = Path(folder) / (key + ".joblib")
+    if not path.exists():
+        _atomic_write(path, lambda tmp: joblib.dump(result, tmp))
+
+
+def load_result(folder, key):
+    """Load the result of a task saved with save_result"""
+    return joblib.load(Path(folder) / (key + ".joblib"))
+
+
+class SolutionStore:
+    """Solution tensors shared by the workers through files
+    Each tensor is a memory-mapped .npy file, in which every task writes
+    its own slice in place, so that no worker holds or returns the full
+    tensor. Tensors listed in sparse are instead saved as one file per
+    written slice, holding its nonzero entries only. The store only keeps
+    its folder and settings, so it is cheap to pass to the workers.
+    Parameters
+    ----------
+    folder: str or Path
+        Folder of the tensors, name.npy for each of them
+    dtype: str or dict
+        Data type of the tensors, e.g. "float32", or of each tensor
+    sparse: tuple
+        Names of the tensors saved with the sparse encoding
+    """
+
+    def __init__(self, folder, dtype="float64", sparse=()):
+        self.folder = Path(folder)
+        self.dtype = dtype
+        self.sparse = tuple(sparse)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def _dtype(self, name):
+        return np.dtype(self.dtype.get(name, "float64") if isinstance(self.dtype, dict)
+                        else self.dtype)
+
+    def _path(self, name):
+        return self.folder / (name + ".npy")
+
+    def create(self, name, shape, reset=False):
+        """Create a tensor of zeros, unless it already exists
+        The file is created under a temporary name and linked to its
+        final name, so that concurrent workers create it only once. An
+        existing tensor must have the same shape and data type, and is
+        kept unless reset is set, e.g. by the process starting a run.
+        Parameters
+        ----------
+        name: str
+            Name of the tensor
+        shape: tuple
+            Shape of the tensor
+        reset: bool
+            Whether to replace an existing tensor by zeros, removing the
+            slices of a sparse tensor
+        """
+        shape, dtype = tuple(shape), self._dtype(name)
+        if name in self.sparse:
+            folder = self.folder / name
+            if folder.is_dir() and not reset:
+                self._check(name, *joblib.load(folder / "shape.joblib"), shape, dtype)
+                return
+            shutil.rmtree(folder, ignore_errors=True)
+            folder.mkdir()
+            _atomic_write(folder / "shape.joblib", lambda tmp: joblib.dump((shape, dtype), tmp))
+            return
+        path = self._path(name)
+        if path.exists() and not reset:
+            tensor = np.load(path, mmap_mode="r")
+            self._check(name, tensor.shape, tensor.dtype, shape, dtype)
+            return
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape).flush()
+        if reset:
+            os.replace(tmp, path)
+            return
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        os.remove(tmp)
+
+    @staticmethod
+    def _check(name, shape, dtype, shape_new, dtype_new):
+        """Raise an error if an existing tensor does not match"""
+        if tuple(shape) != shape_new or np.dtype(dtype) != dtype_new:
+            raise ValueError("Tensor %s exists with shape %s and dtype %s, not %s and %s"
+                             % (name, tuple(shape), np.dtype(dtype), shape_new, dtype_new))
+
+    def write(self, name, index, values, shape=None):
+        """Write a slice of a tensor
+        Parameters
+        ----------
+        name: str
+            Name of the tensor
+        index: tuple
+            Index of the slice, e.g. np.s_[..., r]
+        values: array
+            Values of the slice
+        shape: tuple
+            Shape of the tensor, to create it if it does not exist yet
+        """
+        if shape is not None:
+            self.create(name, shape)
+        values = np.asarray(values, dtype=self._dtype(name))
+        if name in self.sparse:
+            flat = np.flatnonzero(values)
+            path = self.folder / name / (joblib.hash(index) + ".joblib")
+            _atomic_write(path, lambda tmp: joblib.dump(
+                (index, values.shape, flat, values.ravel()[flat]), tmp))
+            return
+        tensor = np.lib.format.open_memmap(self._path(name), mode="r+")
+        tensor[index] = values
+        tensor.flush()
+        del tensor
+
+    def load(self, name):
+        """Return a tensor, memory-mapped read-only, or assembled if sparse"""
+        if name not in self.sparse:
+            return np.load(self._path(name), mmap_mode="r")
+        shape, dtype = joblib.load(self.folder / name / "shape.joblib")
+        tensor = np.zeros(shape, dtype=dtype)
+        for path in sorted((self.folder / name).glob("*.joblib")):
+            if path.name == "shape.joblib":
+                continue
+            index, block_shape, flat, vals = joblib.load(path)
+            block = np.zeros(block_shape, dtype=dtype)
+            block.flat[flat] = vals
+            tensor[index] = block
+        return tensor
+
+    def clear(self):
+        """Remove all the tensors of the store"""
+        for name in self.names():
+            if name in self.sparse:
+                shutil.rmtree(self.folder / name)
+            else:
+                self._path(name).unlink()
+
+    def names(self):
+        """Return the names of the tensors in the store"""
+        dense = [path.stem for path in self.folder.glob("*.npy")]
+        return sorted(dense + [name for name in self.sparse if (self.folder / name).is_dir()])
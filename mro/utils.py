@@ -1,6 +1,16 @@
 import os
+import time
+import functools
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+import joblib
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# Results of the last clustering calls of this process, see disk_cached
+_RECENT = OrderedDict()
+_RECENT_SIZE = 8
 
 def get_n_processes(max_n=np.inf):
     """Get number of processes from current cps number
@@ -24,8 +34,205 @@ def get_n_processes(max_n=np.inf):
 
     return n_proc
 
-def cluster_data(D_in, K):
-    """Return K cluster means after clustering D_in into K clusters
+def _hash_update(h, obj):
+    """Add an argument to a hash, hashing arrays by content"""
+    if isinstance(obj, np.ndarray):
+        h.update(str((obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).view(np.uint8))
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for key in sorted(obj):
+            _hash_update(h, key)
+            _hash_update(h, obj[key])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"(")
+        for item in obj:
+            _hash_update(h, item)
+        h.update(b")")
+    else:
+        h.update(repr(obj).encode())
+
+
+def _evict(cache_dir, max_bytes):
+    """Remove the least recently used files until cache_dir fits in max_bytes"""
+    entries = []
+    for path in Path(cache_dir).glob("*.npz"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _remember(key, result):
+    """Keep a clustering result in memory, dropping the oldest ones"""
+    _RECENT[key] = result
+    while len(_RECENT) > _RECENT_SIZE:
+        _RECENT.popitem(last=False)
+    return result
+
+
+def disk_cached(pack, unpack):
+    """Cache the results of a clustering function on disk
+    The decorated function takes two additional keyword arguments,
+    cache_dir (defaults to the MRO_CLUSTER_CACHE environment variable, no
+    caching if unset) and max_bytes, the size above which the least
+    recently used results are evicted. Results are keyed by a hash of the
+    input dataset and all other arguments, stored as compressed .npz
+    files, and written atomically so that parallel workers can share the
+    same cache directory. The results of the last few calls are also kept
+    in memory, with or without cache_dir, so that repeated calls on the
+    same data in a process cluster it once.
+    Parameters
+    ----------
+    pack: function
+        Maps a result to a dict of arrays
+    unpack: function
+        Maps the dict of arrays back to the result
+    Returns
+    -------
+    function
+        Decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(D_in, *args, cache_dir=None, max_bytes=2**30, **kwargs):
+            if cache_dir is None:
+                cache_dir = os.environ.get("MRO_CLUSTER_CACHE")
+            if not isinstance(D_in, np.ndarray):
+                return func(D_in, *args, **kwargs)
+
+            h = hashlib.sha256(func.__name__.encode())
+            for obj in (D_in,) + args + tuple(sorted(kwargs.items())):
+                _hash_update(h, obj)
+            key = h.hexdigest()
+            if key in _RECENT:
+                _RECENT.move_to_end(key)
+                return _RECENT[key]
+            if not cache_dir:
+                return _remember(key, func(D_in, *args, **kwargs))
+            path = Path(cache_dir) / (key + ".npz")
+            try:
+                with np.load(path) as f:
+                    result = unpack({name: f[name] for name in f.files})
+                os.utime(path)
+                return _remember(key, result)
+            except (OSError, ValueError, KeyError):
+                pass
+
+            result = func(D_in, *args, **kwargs)
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name("%s.%d.tmp" % (path.stem, os.getpid()))
+            with open(tmp, "wb") as f:
+                np.savez_compressed(f, **pack(result))
+            os.replace(tmp, path)
+            _evict(cache_dir, max_bytes)
+            return _remember(key, result)
+        return wrapper
+    return decorator
+
+
+def iter_chunks(D_in, chunk_size, rng=None):
+    """Yield consecutive blocks of rows of a dataset
+    Parameters
+    ----------
+    D_in: array, str or callable
+        Input dataset, path to a .npy file that is memory-mapped, or
+        callable returning an iterable of row blocks
+    chunk_size: int
+        Maximum number of rows per block
+    rng: numpy.random.Generator
+        If given, the rows of an array or file are read in a random order,
+        so that every block is a sample without replacement of the whole
+        dataset, each block being read in increasing row order. The rows
+        of the blocks of a callable are only shuffled within each block.
+    Returns
+    -------
+    generator
+        Blocks of at most chunk_size rows
+    """
+    if callable(D_in):
+        for block in D_in():
+            block = np.asarray(block, dtype=float)
+            if rng is not None:
+                block = block[rng.permutation(block.shape[0])]
+            for start in range(0, block.shape[0], chunk_size):
+                yield block[start:start + chunk_size]
+        return
+    if isinstance(D_in, (str, os.PathLike)):
+        D_in = np.load(D_in, mmap_mode="r")
+    if rng is None:
+        for start in range(0, D_in.shape[0], chunk_size):
+            yield np.asarray(D_in[start:start + chunk_size], dtype=float)
+        return
+    order = rng.permutation(D_in.shape[0])
+    for start in range(0, D_in.shape[0], chunk_size):
+        yield np.asarray(D_in[np.sort(order[start:start + chunk_size])], dtype=float)
+
+
+def _cluster_stream(D_in, K, chunk_size, **kwargs):
+    """Cluster a dataset read block by block with MiniBatchKMeans
+    The centers are fitted with one partial_fit per block, the blocks
+    being random samples of the whole dataset (see iter_chunks), so that
+    the centers seeded on the first block do not depend on the order of
+    the data. A second pass assigns every entry and replaces each center
+    by the mean of its cluster.
+    Parameters
+    ----------
+    D_in: array, str or callable
+        Input dataset, see iter_chunks
+    K: int
+        Number of clusters
+    chunk_size: int
+        Number of rows held in memory at once
+    Returns
+    -------
+    Dbar_in: array
+        Output dataset, K entries
+    weights: vector
+        Vector of weights for Dbar_in
+    """
+    kmeans = MiniBatchKMeans(n_clusters=K, **kwargs)
+    rng = np.random.default_rng(kwargs.get("random_state"))
+    block_buffer = None
+    for block in iter_chunks(D_in, chunk_size, rng):
+        if not hasattr(kmeans, "cluster_centers_"):
+            # the first call to partial_fit needs at least K entries
+            block_buffer = block if block_buffer is None else np.vstack(
+                [block_buffer, block])
+            if block_buffer.shape[0] < K:
+                continue
+            block, block_buffer = block_buffer, None
+        kmeans.partial_fit(block)
+    if block_buffer is not None:
+        raise ValueError("Input dataset has fewer than K entries")
+
+    sums = np.zeros(kmeans.cluster_centers_.shape)
+    counts = np.zeros(K)
+    for block in iter_chunks(D_in, chunk_size):
+        labels = kmeans.predict(block)
+        np.add.at(sums, labels, block)
+        counts += np.bincount(labels, minlength=K)
+    Dbar_in = kmeans.cluster_centers_.copy()
+    nonempty = counts > 0
+    Dbar_in[nonempty] = sums[nonempty] / counts[nonempty, None]
+    weights = counts / np.sum(counts)
+
+    return Dbar_in, weights
+
+
+def compress_data(D_in):
+    """Merge identical entries of D_in into weighted unique scenarios
     Parameters
     ----------
     D_in: array
@@ -33,13 +240,224 @@ def cluster_data(D_in, K):
     Returns
     -------
     Dbar_in: array
-        Output dataset, K entries
+        Unique entries of D_in
+    weights: vector
+        Multiplicity of each unique entry divided by N
+    """
+    Dbar_in, counts = np.unique(D_in, axis=0, return_counts=True)
+    return Dbar_in, counts / D_in.shape[0]
+
+
+@disk_cached(lambda res: {"Dbar_in": res[0], "weights": res[1]},
+             lambda f: (f["Dbar_in"], f["weights"]))
+def cluster_data(D_in, K, method="kmeans", chunk_size=100000, **kwargs):
+    """Return K cluster means after clustering D_in into K clusters
+    Parameters
+    ----------
+    D_in: array, str or callable
+        Input dataset, N entries. The "stream" method also accepts the
+        path of a .npy file or a callable returning row blocks
+    K: int
+        Number of clusters
+    method: str
+        Clustering backend, "kmeans" for full KMeans, "minibatch" for
+        MiniBatchKMeans, or "stream" for MiniBatchKMeans on blocks of
+        chunk_size rows read one at a time
+    chunk_size: int
+        Number of rows held in memory at once by the "stream" method
+    kwargs: dict
+        Additional arguments passed to the sklearn estimator
+    Returns
+    -------
+    Dbar_in: array
+        Output dataset, at most K entries. Duplicate entries of D_in are
+        merged first, and if there are at most K unique entries they are
+        returned without clustering
     weights: vector
         Vector of weights for Dbar_in
-    """    
-    N = D_in.shape[0]
-    kmeans = KMeans(n_clusters=K).fit(D_in)
+    """
+    if method == "stream":
+        return _cluster_stream(D_in, K, chunk_size, **kwargs)
+    if method not in ("kmeans", "minibatch"):
+        raise ValueError("Unknown clustering method %s" % method)
+    D_unique, weights = compress_data(D_in)
+    if K >= D_unique.shape[0]:
+        return D_unique, weights
+    if method == "kmeans":
+        kmeans = KMeans(n_clusters=K, **kwargs)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=K, **kwargs)
+    kmeans.fit(D_unique, sample_weight=weights)
     Dbar_in = kmeans.cluster_centers_
-    weights = np.bincount(kmeans.labels_) / N
+    weights = np.bincount(kmeans.labels_, weights=weights, minlength=K)
 
     return Dbar_in, weights
+
+
+def _extend_centers(D_in, centers, K):
+    """Complete a set of centers to K centers by farthest point seeding
+    Parameters
+    ----------
+    D_in: array
+        Input dataset, N entries
+    centers: array
+        Current cluster centers
+    K: int
+        Number of centers to return
+    Returns
+    -------
+    init: array
+        K initial centers, starting with the current ones
+    """
+    init = np.zeros((K, D_in.shape[1]))
+    init[:centers.shape[0]] = centers
+    sq_norms = np.sum(D_in**2, axis=1)
+    dists = np.min(sq_norms[:, None] - 2*D_in@centers.T +
+                   np.sum(centers**2, axis=1)[None, :], axis=1)
+    for k in range(centers.shape[0], K):
+        ind = np.argmax(dists)
+        init[k] = D_in[ind]
+        dists = np.minimum(dists, np.sum((D_in - D_in[ind])**2, axis=1))
+    return init
+
+
+def _inertia(D_in, centers, chunk_size):
+    """Sum over the entries of the squared distance to the closest center"""
+    total = 0.
+    for block in iter_chunks(D_in, chunk_size):
+        dists = (np.sum(block**2, axis=1)[:, None] - 2*block@centers.T
+                 + np.sum(centers**2, axis=1)[None, :])
+        total += np.sum(np.maximum(np.min(dists, axis=1), 0))
+    return total
+
+
+def _pack_path(path):
+    """Store a cluster_data_path result as a dict of arrays"""
+    arrays = {"inertia": np.array([inertia for _, _, inertia, _ in path]),
+              "fittime": np.array([fittime for _, _, _, fittime in path])}
+    for K_count, (Dbar_in, weights, _, _) in enumerate(path):
+        arrays["Dbar_in_%d" % K_count] = Dbar_in
+        arrays["weights_%d" % K_count] = weights
+    return arrays
+
+
+def _unpack_path(arrays):
+    """Rebuild a cluster_data_path result from a dict of arrays"""
+    return [(arrays["Dbar_in_%d" % K_count], arrays["weights_%d" % K_count],
+             inertia, fittime)
+            for K_count, (inertia, fittime) in enumerate(zip(arrays["inertia"], arrays["fittime"]))]
+
+
+def iter_cluster_path(D_in, K_nums, method="kmeans", chunk_size=100000, **kwargs):
+    """Yield the cluster means for each K in K_nums, one K at a time
+    Duplicate entries of D_in are merged first. Each K is clustered with
+    the default k-means++ restarts of KMeans, and each K larger than the
+    previous one also from a warm start, the previous centers completed
+    with the points farthest from their current center, the fit with the
+    lowest inertia being kept. The warm start alone can be trapped in a
+    poor local optimum, so it only adds a candidate. Any K at least the
+    number of unique entries
+    returns the unique entries without clustering. The clustering of a K
+    is only done when the caller asks for it, so that callers stopping
+    early do not pay for the larger K. The other methods of cluster_data
+    cluster each K on its own.
+    Parameters
+    ----------
+    D_in: array, str or callable
+        Input dataset, N entries, or any input of cluster_data for the
+        other methods
+    K_nums: vector
+        Numbers of clusters to consider, best in increasing order
+    method: str
+        Clustering backend, see cluster_data
+    chunk_size: int
+        Number of rows held in memory at once by the "stream" method
+    kwargs: dict
+        Additional arguments passed to the sklearn estimator
+    Returns
+    -------
+    generator
+        (Dbar_in, weights, inertia, fittime) tuples, in the order of
+        K_nums, where fittime is the time spent clustering that K, 0 when
+        no clustering is needed
+    """
+    if method != "kmeans":
+        for K in K_nums:
+            tnow = time.time()
+            Dbar_in, weights = cluster_data(D_in, int(K), method, chunk_size, **kwargs)
+            yield (Dbar_in, weights, _inertia(D_in, Dbar_in, chunk_size),
+                   time.time() - tnow)
+        return
+    D_unique, counts = compress_data(D_in)
+    prev = None
+    for K in K_nums:
+        K = int(K)
+        if K >= D_unique.shape[0]:
+            yield D_unique, counts, 0., 0.
+            continue
+        if prev is not None and K == prev[0].shape[0]:
+            yield prev[:3] + (0.,)
+            continue
+        tnow = time.time()
+        kmeans = KMeans(n_clusters=K, **kwargs).fit(D_unique, sample_weight=counts)
+        if prev is not None and K > prev[0].shape[0]:
+            warm = KMeans(n_clusters=K, **dict(kwargs, init=_extend_centers(
+                D_unique, prev[0], K), n_init=1)).fit(D_unique, sample_weight=counts)
+            if warm.inertia_ < kmeans.inertia_:
+                kmeans = warm
+        weights = np.bincount(kmeans.labels_, weights=counts, minlength=K)
+        prev = (kmeans.cluster_centers_, weights, kmeans.inertia_ * D_in.shape[0],
+                time.time() - tnow)
+        yield prev
+
+
+@disk_cached(_pack_path, _unpack_path)
+def cluster_data_path(D_in, K_nums, method="kmeans", chunk_size=100000, **kwargs):
+    """Return the cluster means for every K in K_nums in a single pass
+    The K are clustered in increasing order with iter_cluster_path, each
+    one also trying a warm start from the centers of the previous K.
+    Parameters
+    ----------
+    D_in: array, str or callable
+        Input dataset, N entries, see iter_cluster_path
+    K_nums: vector
+        Numbers of clusters to consider
+    method, chunk_size, kwargs:
+        Clustering backend and its arguments, see iter_cluster_path
+    Returns
+    -------
+    path: list
+        List of (Dbar_in, weights, inertia, fittime) tuples, in the order
+        of K_nums, see iter_cluster_path
+    """
+    order = np.argsort(K_nums, kind="stable")
+    path = [None]*len(K_nums)
+    for K_count, res in zip(order, iter_cluster_path(
+            D_in, np.asarray(K_nums)[order], method, chunk_size, **kwargs)):
+        path[K_count] = res
+    return path
+
+
+def cluster_path(D_in, K_nums, lazy=False, **kwargs):
+    """Return the cluster means for every K in K_nums
+    Parameters
+    ----------
+    D_in: array
+        Input dataset, N entries
+    K_nums: vector
+        Numbers of clusters to consider
+    lazy: bool
+        Whether to cluster each K only when it is reached, for callers that
+        may stop early, instead of clustering every K up front
+    kwargs: dict
+        Clustering backend and its arguments, e.g. {"method": "stream",
+        "chunk_size": 10000}, see iter_cluster_path
+    Returns
+    -------
+    path: list or generator
+        (Dbar_in, weights, inertia, fittime) tuples, in the order of
+        K_nums, see iter_cluster_path and cluster_data_path
+    """
+    if lazy:
+        return iter_cluster_path(D_in, K_nums, **kwargs)
+    return cluster_data_path(D_in, K_nums, **kwargs)
@@ -17,14 +17,22 @@ import pandas as pd
 import sys
 import time
 output_stream = sys.stdout
-from mro.utils import get_n_processes, cluster_data
+from mro.utils import get_n_processes, cluster_path
+from mro.formulation import affine_collapsible, collapse_affine, mro_constraints
+from mro.results import ResultRecorder, ResultAggregator
+from mro.store import SolutionStore
+from mro.datasets import DatasetRegistry, resolve
+from mro.evaluation import news_eval, stream_eval, sequential_eval, add_interval
+from mro.problems import cached_problem, compile_problem, solve_eps_path
+from mro.search import K_converged
 
 
 def createproblem_news(N, m):
     """Create the problem in cvxpy, minimize CVaR of loss"""
     # m = 10
     # PARAMETERS #
-    dat = cp.Parameter((N, m))
+    # revenue d@p of each cluster, so that the problem is DPP
+    dat = cp.Parameter((N, 1))
     eps = cp.Parameter()
     w = cp.Parameter(N)
     p = cp.Parameter(m)
@@ -48,13 +56,12 @@ def createproblem_news(N, m):
     objective = t
 
     # CONSTRAINTS #
-    constraints = [cp.multiply(eps, lam) + w@s <= t]
-    constraints += [cp.hstack([a_1*(a@q + 0.5*a@y) + b_1*tao]*N) + a_1*dat@(-p) +
-                    cp.hstack([cp.quad_over_lin(a_1*p, 4*lam)]*N) <= s]
+    constraints = mro_constraints(dat, w, eps, lam, s,
+                                  a_1*(a@q + 0.5*a@y) + b_1*tao, np.array([-a_1]),
+                                  penalty=cp.quad_over_lin(-a_1*p, 4*lam), bound=t)
     constraints += [a_1*(-p@q + a@q + 0.5*a@y) + b_1*tao <= t]
     constraints += [10*tao <= t]
     constraints += [q - b <= y, 0 <= y, a@q + 0.5*a@y <= 20, q >= 0, q <= 5*b]
-    constraints += [lam >= 0]
     constraints += [q - 10*z <= 0, cp.sum(z) <= 30]
 
     # PROBLEM #
@@ -82,59 +89,144 @@ def generate_news_demands(mu, sig, N_tot, m=10, R_samples=30):
     return d_train
 
 
-def news_experiment(dat, dateval, r, m, a, b, p, prob, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername):
-    '''run the experiment for multiple K and epsilon'''
-    q_sols = np.zeros((K_tot, eps_tot, m, R))
-    df = pd.DataFrame(columns=["K", "Epsilon", "Opt_val",
-                               "satisfy", "solvetime", "clustertime", "setuptime"])
-    Data = dat
-    Data_eval = dateval
+def news_experiment(dat, dateval, r, m, a, b, p, prob, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, sequential=None, K_tol=None, clustering=None, store=None):
+    '''run the experiment for multiple K and epsilon
+    sequential: dict
+        If given, evaluate with mro.evaluation.sequential_eval using these
+        keyword arguments, and add the interval to the results
+    K_tol: float
+        If given, stop increasing K once the change in objective over all
+        epsilons is within K_tol
+    clustering: dict
+        Keyword arguments of mro.utils.cluster_path, e.g.
+        {"method": "stream", "chunk_size": 10000}
+    store: mro.store.SolutionStore
+        If given, write the optimal solutions in slice r of its tensors
+        instead of returning them
+    '''
+    q_sols = np.zeros((K_tot, eps_tot, m))
+    y_sols = np.zeros((K_tot, eps_tot, m))
+    tao_sols = np.zeros((K_tot, eps_tot))
+    t_sols = np.zeros((K_tot, eps_tot))
+    rec = ResultRecorder(K_tot*eps_tot, {
+        "K": int, "Epsilon": float, "Opt_val": float, "satisfy": bool,
+        "solvetime": float, "iters": float, "clustertime": float, "setuptime": float})
+    Data = resolve(dat)
+    Data_eval = resolve(dateval)
+    clusters = cluster_path(Data[r], K_nums, lazy=K_tol is not None,
+                            **(clustering or {}))
+    probe = cached_problem(prob, 1, m, solver=cp.MOSEK)
+    collapse = affine_collapsible(probe[0], probe[-3])
 
-    ######################## solve for various K ########################
-    for K_count, K in enumerate(K_nums):
+    evaldat = Data_eval[r]
 
-        if K == N_tot:
-            d_train, wk = cluster_data(Data[r], K)
-            clustertimes = 0
-        else:
-            tnow = time.time()
-            d_train, wk = cluster_data(Data[r], K)
-            clustertimes = time.time() - tnow
+    ######################## solve for various K ########################
+    res_prev = None
+    for K_count, (K, (d_train, wk, _, clustertimes)) in enumerate(zip(K_nums, clusters)):
+        if collapse:
+            d_train, wk = collapse_affine(d_train, wk)
 
-        evaldat = Data_eval[r]
         tnow = time.time()
-        problem, q, y, tao, z, p_pm, a_pm, b_pm, t, lam_pm, dat_pm, eps_pm, w_pm = prob(
-            K, m)
+        problem, q, y, tao, z, p_pm, a_pm, b_pm, t, lam_pm, dat_pm, eps_pm, w_pm = cached_problem(
+            prob, d_train.shape[0], m, solver=cp.MOSEK)
         a_pm.value = np.array(a)
         b_pm.value = np.array(b)
         p_pm.value = np.array(p)
-        dat_pm.value = d_train
+        dat_pm.value = (d_train @ p)[:, None]
         w_pm.value = wk
+        eps_pm.value = eps_nums[0]
+        compile_problem(problem, cp.MOSEK)
         setuptimes = time.time() - tnow
 
         ########## solve for various epsilons ##############
-        for eps_count, eps in enumerate(eps_nums):
-            eps_pm.value = eps
-            problem.solve(ignore_dpp=True, solver=cp.MOSEK, verbose=True, mosek_params={
-                          mosek.dparam.optimizer_max_time:  1000.0})
-            q_sols[K_count, eps_count, :, r] = q.value
-            evalvalue = -50*np.mean(evaldat@p_pm.value) + 50 * \
-                (a@q.value + 0.5*a@y.value) - 40*tao.value - t.value <= 0
-            newrow = pd.Series(
+        for eps_count, eps, iters in solve_eps_path(problem, eps_pm, eps_nums, solver=cp.MOSEK, verbose=True, mosek_params={
+                mosek.dparam.optimizer_max_time:  1000.0}):
+            q_sols[K_count, eps_count, :] = q.value
+            y_sols[K_count, eps_count] = y.value
+            tao_sols[K_count, eps_count] = tao.value
+            t_sols[K_count, eps_count] = t.value
+            rec.append(
                 {"K": K,
                  "Epsilon": eps,
                  "Opt_val": problem.objective.value,
-                 "satisfy": evalvalue,
                  "solvetime": problem.solver_stats.solve_time,
+                 "iters": iters,
                  "clustertime": clustertimes,
                  "setuptime": setuptimes
                  })
-            df = df.append(newrow, ignore_index=True)
 
             #df.to_csv('/scratch/gpfs/iywang/mro_results/' +
             #          foldername + '/df.csv')
+        if K_tol is not None:
+            res = rec.select(rec["K"] == K)
+            if K_converged(res, res_prev, K_tol):
+                break
+            res_prev = res
+
+    if sequential is None:
+        evalvalue = stream_eval(news_eval, evaldat, a, p, q_sols[:K_count + 1], y_sols[:K_count + 1], tao_sols[:K_count + 1], t_sols[:K_count + 1])
+        rec["satisfy"] = evalvalue.ravel() <= 0
+    else:
+        res = sequential_eval(news_eval, evaldat, a, p, q_sols[:K_count + 1], y_sols[:K_count + 1], tao_sols[:K_count + 1], t_sols[:K_count + 1],
+                              **sequential)
+        rec["satisfy"] = res["satisfy"].ravel()
+        add_interval(rec, res)
+
+    if store is not None:
+        store.write("q_sols", np.s_[..., r], q_sols)
+        q_sols = None
+    return q_sols, rec.buffers()
+
+
+def setup(config):
+    """Build the inputs of run_task from a runner config
+    Parameters
+    ----------
+    config: dict
+        Runner config, with "m", "N_tot", "R", and optionally "seed",
+        "foldername", "sequential" and "clustering"
+    Returns
+    -------
+    dict
+        The data of every task
+    """
+    np.random.seed(config.get("seed", 0))
+    m = config["m"]
+    a, b, p, mu, sig = generate_news_params(m)
+    return {"dat": generate_news_demands(mu, sig, config["N_tot"], m, config["R"]),
+            "dateval": generate_news_demands(mu, sig, config["N_tot"], m, config["R"]),
+            "m": m, "a": a, "b": b, "p": p,
+            "N_tot": config["N_tot"],
+            "foldername": config.get("foldername", ""),
+            "sequential": config.get("sequential"),
+            "clustering": config.get("clustering")}
+
 
-    return q_sols, df
+def run_task(data, r, K_nums, eps_nums):
+    """Run news_experiment for one replicate on part of the grid
+    Parameters
+    ----------
+    data: dict
+        Output of setup
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters
+    eps_nums: vector
+        Epsilons
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K and epsilon axes first
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
+    """
+    q_sols, df = news_experiment(
+        data["dat"], data["dateval"], r, data["m"], data["a"], data["b"], data["p"],
+        createproblem_news, data["N_tot"], len(K_nums), K_nums, len(eps_nums), eps_nums,
+        data["foldername"], sequential=data["sequential"],
+        clustering=data["clustering"])
+    return {"q_sols": q_sols}, df
 
 
 if __name__ == '__main__':
@@ -150,23 +242,23 @@ if __name__ == '__main__':
     eps_nums = np.linspace(eps_min, eps_max, M)
     eps_nums = 10**(eps_nums)
     eps_tot = M
+    K_tol = None    # stop increasing K once the objective changes by less
     a, b, p, mu, sig = generate_news_params(m)
 
     dat = generate_news_demands(mu, sig, N_tot, m, R)
     dateval = generate_news_demands(mu, sig, N_tot, m, R)
     njobs = get_n_processes(30)
 
-    results = Parallel(n_jobs=njobs)(delayed(news_experiment)(dat, dateval, r, m, a, b, p,
-                                                              createproblem_news, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername) for r in range(R))
+    with DatasetRegistry() as registry:
+        dat, dateval = registry.add("dat", dat), registry.add("dateval", dateval)
+        store = SolutionStore("/scratch/gpfs/iywang/mro_results/" + foldername)
+        store.create("q_sols", (K_tot, eps_tot, m, R), reset=True)
+        results = Parallel(n_jobs=njobs, return_as="generator")(delayed(news_experiment)(dat, dateval, r, m, a, b, p,
+                                                                  createproblem_news, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, K_tol=K_tol, store=store) for r in range(R))
 
-    q_sols = np.zeros((K_tot, eps_tot, m, R))
-    for r in range(R):
-        q_sols += results[r][0]
-    dftemp = results[0][1].reset_index()
-    for r in range(1, R):
-        dftemp = dftemp.add(results[r][1].reset_index(), fill_value=0)
-    dftemp = dftemp/R
+        agg = ResultAggregator()
+        for _, df_r in results:
+            agg.update(df_r)
+    dftemp = agg.to_frame()
 
-    np.save(Path("/scratch/gpfs/iywang/mro_results/" +
-            foldername + "/q_sols.npy"), q_sols)
     dftemp.to_csv('/scratch/gpfs/iywang/mro_results/' + foldername + '/df.csv')
@@ -15,7 +15,14 @@ import cvxpy as cp
 import matplotlib.pyplot as plt
 from pathlib import Path
 import sys
-from mro.utils import get_n_processes, cluster_data
+from mro.utils import get_n_processes, cluster_path
+from mro.formulation import affine_collapsible, collapse_affine, mro_constraints
+from mro.results import ResultRecorder, ResultAggregator
+from mro.store import SolutionStore
+from mro.datasets import DatasetRegistry, resolve, load_csv
+from mro.evaluation import portfolio_eval, stream_eval, sequential_eval, add_interval
+from mro.problems import cached_problem, compile_problem, solve_eps_path
+from mro.search import K_converged
 output_stream = sys.stdout
 
 def createproblem_portMIP(N, m):
@@ -48,74 +55,162 @@ def createproblem_portMIP(N, m):
     objective = tao + y
 
     # CONSTRAINTS #
-    constraints = [cp.multiply(eps, lam) + w@s <= y]
-    constraints += [cp.hstack([a*tao]*N) + a*dat@x +
-                    cp.hstack([cp.quad_over_lin(-a*x, 4*lam)]*N) <= s]
+    constraints = mro_constraints(dat, w, eps, lam, s, a*tao, a*x, bound=y)
     constraints += [cp.sum(x) == 1]
     constraints += [x >= 0, x <= 1]
-    constraints += [lam >= 0,y>=0]
+    constraints += [y>=0]
     constraints += [x - z <= 0, cp.sum(z) <= 5]
     # PROBLEM #
     problem = cp.Problem(cp.Minimize(objective), constraints)
     return problem, x, s, tao,y, lam, dat, eps, w
 
 
-def port_experiment(dat, dateval, r, m, prob, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername):
+def port_experiment(dat, dateval, r, m, prob, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, sequential=None, K_tol=None, clustering=None, store=None):
     """Run the experiment for multiple K and epsilon
     Parameters
     ----------
-    Various inputs for combinations of experiments
+    Various inputs for combinations of experiments, the datasets being
+    arrays or references of a mro.datasets.DatasetRegistry
+    sequential: dict
+        If given, evaluate with mro.evaluation.sequential_eval using these
+        keyword arguments, and add the interval to the results
+    K_tol: float
+        If given, stop increasing K once the change in objective over all
+        epsilons is within K_tol
+    clustering: dict
+        Keyword arguments of mro.utils.cluster_path, e.g.
+        {"method": "stream", "chunk_size": 10000}
+    store: mro.store.SolutionStore
+        If given, write the optimal solutions in slice r of its tensors
+        instead of returning them
     Returns
     -------
     x_sols: array
-        The optimal solutions
-    df: dataframe
-        The results of the experiments
+        The optimal solutions, None if written in store
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
     """
-    x_sols = np.zeros((K_tot, eps_tot, m, R))
-    df = pd.DataFrame(columns=["K", "Epsilon", "Opt_val", "Eval_val",
-                               "satisfy", "solvetime", "setuptime"])
-    Data = dat
-    Data_eval = dateval
+    x_sols = np.zeros((K_tot, eps_tot, m))
+    tao_sols = np.zeros((K_tot, eps_tot))
+    y_sols = np.zeros((K_tot, eps_tot))
+    rec = ResultRecorder(K_tot*eps_tot, {
+        "K": int, "Epsilon": float, "Opt_val": float, "Eval_val": bool, "satisfy": bool,
+        "solvetime": float, "iters": float, "setuptime": float, "clustertime": float})
+    Data = resolve(dat)
+    Data_eval = resolve(dateval)
+
+    clusters = cluster_path(Data[(N_tot*r):(N_tot*(r+1))], K_nums, lazy=K_tol is not None,
+                            **(clustering or {}))
+    probe = cached_problem(prob, 1, m, solver=cp.MOSEK)
+    collapse = affine_collapsible(probe[0], probe[-3])
+
+    d_eval = Data_eval[(N_tot*r):(N_tot*(r+1))]
 
    ######################## solve for various K ########################
-    for K_count, K in enumerate(K_nums):
+    res_prev = None
+    for K_count, (K, (d_train, wk, _, clustertimes)) in enumerate(zip(K_nums, clusters)):
         tnow = time.time()
-        d_train, wk = cluster_data(Data[(N_tot*r):(N_tot*(r+1))], K)
-        d_eval = Data_eval[(N_tot*r):(N_tot*(r+1))]
-        assert(d_train.shape == (K, m))
-        problem, x, s, tao,y, lmbda, data_train_pm, eps_pm, w_pm = prob(K, m)
+        if collapse:
+            d_train, wk = collapse_affine(d_train, wk)
+        assert(d_train.shape[0] <= K and d_train.shape[1] == m)
+        problem, x, s, tao,y, lmbda, data_train_pm, eps_pm, w_pm = cached_problem(
+            prob, d_train.shape[0], m, solver=cp.MOSEK)
         data_train_pm.value = d_train
         w_pm.value = wk
+        eps_pm.value = eps_nums[0]
+        compile_problem(problem, cp.MOSEK)
         setuptimes = time.time() - tnow
 
         ############## solve for various epsilons ###################
-        for eps_count, eps in enumerate(eps_nums):
-            eps_pm.value = eps
-            problem.solve(ignore_dpp=True, solver=cp.MOSEK, verbose=True, mosek_params={
-                          mosek.dparam.optimizer_max_time:  1200.0})
-            x_sols[K_count, eps_count, :, r] = x.value
-            evalvalue = -5*np.mean(d_eval@x.value) - 5*tao.value <= y.value
-            newrow = pd.Series(
+        for eps_count, eps, iters in solve_eps_path(problem, eps_pm, eps_nums, solver=cp.MOSEK, verbose=True, mosek_params={
+                mosek.dparam.optimizer_max_time:  1200.0}):
+            x_sols[K_count, eps_count, :] = x.value
+            tao_sols[K_count, eps_count] = tao.value
+            y_sols[K_count, eps_count] = y.value
+            rec.append(
                 {"K": K,
                  "Epsilon": eps,
                  "Opt_val": problem.objective.value,
-                 "Eval_val": evalvalue,
-                 "satisfy": evalvalue,
                  "solvetime": problem.solver_stats.solve_time,
-                 "setuptime": setuptimes
+                 "iters": iters,
+                 "setuptime": setuptimes,
+                 "clustertime": clustertimes
                  })
-            df = df.append(newrow, ignore_index=True)
             #df.to_csv('/scratch/gpfs/iywang/mro_results/' +
             #          foldername + '/df.csv')
+        if K_tol is not None:
+            res = rec.select(rec["K"] == K)
+            if K_converged(res, res_prev, K_tol):
+                break
+            res_prev = res
+
+    if sequential is None:
+        evalvalue = stream_eval(portfolio_eval, d_eval, x_sols[:K_count + 1], tao_sols[:K_count + 1]) <= y_sols[:K_count + 1]
+    else:
+        res = sequential_eval(portfolio_eval, d_eval, x_sols[:K_count + 1], tao_sols[:K_count + 1],
+                              bound=y_sols[:K_count + 1], **sequential)
+        evalvalue = res["satisfy"]
+        add_interval(rec, res)
+    rec["Eval_val"] = evalvalue.ravel()
+    rec["satisfy"] = evalvalue.ravel()
+
+    if store is not None:
+        store.write("x_sols", np.s_[..., r], x_sols)
+        x_sols = None
+    return x_sols, rec.buffers()
+
 
-    return x_sols, df
+def setup(config):
+    """Build the inputs of run_task from a runner config
+    Parameters
+    ----------
+    config: dict
+        Runner config, with the path of the returns in "data", "m",
+        "N_tot", and optionally "foldername", "sequential" and "clustering"
+    Returns
+    -------
+    dict
+        The data of every task
+    """
+    m = config["m"]
+    return {"dat": load_csv(config["data"], np.s_[:5000], np.s_[:m]),
+            "dateval": load_csv(config["data"], np.s_[-5000:], np.s_[:m]),
+            "m": m,
+            "N_tot": config["N_tot"],
+            "foldername": config.get("foldername", ""),
+            "sequential": config.get("sequential"),
+            "clustering": config.get("clustering")}
+
+
+def run_task(data, r, K_nums, eps_nums):
+    """Run port_experiment for one replicate on part of the grid
+    Parameters
+    ----------
+    data: dict
+        Output of setup
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters
+    eps_nums: vector
+        Epsilons
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K and epsilon axes first
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
+    """
+    x_sols, df = port_experiment(
+        data["dat"], data["dateval"], r, data["m"], createproblem_portMIP, data["N_tot"], len(K_nums), K_nums,
+        len(eps_nums), eps_nums, data["foldername"], sequential=data["sequential"],
+        clustering=data["clustering"])
+    return {"x_sols": x_sols}, df
 
 
 if __name__ == '__main__':
     foldername = "portfolio/MIP/m50_K300_r12"
-    synthetic_returns = pd.read_csv(
-        '/scratch/gpfs/iywang/mro_experiments/portfolio/sp500_synthetic_returns.csv').to_numpy()[:, 1:]
+    returns_path = '/scratch/gpfs/iywang/mro_experiments/portfolio/sp500_synthetic_returns.csv'
 
     K_nums = np.array([1, 5, 50, 100, 150, 300])
     K_tot = K_nums.size  # Total number of clusters we consider
@@ -128,21 +223,21 @@ if __name__ == '__main__':
     eps_nums = np.linspace(eps_min, eps_max, M)
     eps_nums = 10**(eps_nums)
     eps_tot = M
+    K_tol = None    # stop increasing K once the objective changes by less
 
-    dat = synthetic_returns[:5000, :m]
-    dateval = synthetic_returns[-5000:, :m]
+    dat = load_csv(returns_path, np.s_[:5000], np.s_[:m])
+    dateval = load_csv(returns_path, np.s_[-5000:], np.s_[:m])
     njobs = get_n_processes(20)
-    results = Parallel(n_jobs=njobs)(delayed(port_experiment)(
-        dat, dateval, r, m, createproblem_portMIP, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername) for r in range(R))
-
-    x_sols = np.zeros((K_tot, eps_tot, m, R))
-    dftemp = results[0][1]
-    for r in range(R):
-        x_sols += results[r][0]
-    for r in range(1, R):
-        dftemp = dftemp.add(results[r][1].reset_index(), fill_value=0)
-    dftemp = dftemp/R
-
-    np.save(Path("/scratch/gpfs/iywang/mro_results/" +
-            foldername + "/x_sols.npy"), x_sols)
+    with DatasetRegistry() as registry:
+        dat, dateval = registry.add("dat", dat), registry.add("dateval", dateval)
+        store = SolutionStore("/scratch/gpfs/iywang/mro_results/" + foldername)
+        store.create("x_sols", (K_tot, eps_tot, m, R), reset=True)
+        results = Parallel(n_jobs=njobs, return_as="generator")(delayed(port_experiment)(
+            dat, dateval, r, m, createproblem_portMIP, N_tot, K_tot, K_nums, eps_tot, eps_nums, foldername, K_tol=K_tol, store=store) for r in range(R))
+
+        agg = ResultAggregator()
+        for _, df_r in results:
+            agg.update(df_r)
+    dftemp = agg.to_frame()
+
     dftemp.to_csv('/scratch/gpfs/iywang/mro_results/' + foldername + '/df.csv')
\ No newline at end of file
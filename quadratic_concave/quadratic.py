@@ -1,15 +1,24 @@
 from sklearn.cluster import KMeans
+from sklearn import datasets
 from pathlib import Path
 from joblib import Parallel, delayed
 import os
 import mosek
 import time
 import numpy as np
+import scipy as sc
+import scipy.linalg
 import cvxpy as cp
 import matplotlib.pyplot as plt
 import pandas as pd
 import sys
-from mro.utils import get_n_processes, cluster_data
+from mro.utils import get_n_processes, cluster_path
+from mro.formulation import second_moment_factor
+from mro.problems import cached_problem
+from mro.results import ResultRecorder, ResultAggregator
+from mro.store import SolutionStore
+from mro.evaluation import quadratic_eval, stream_eval
+from mro.search import K_converged
 
 
 def normal_returns_scaled(N, m,scale):
@@ -97,46 +106,156 @@ def createproblem_quad(N, m,A):
     problem = cp.Problem(cp.Minimize(objective), constraints)
     return problem, x, s, lam, dat, eps, w
 
-def quadratic_experiment(A, Ainv, r, m, N_tot, K_nums, eps_nums, foldername):
+def createproblem_quad_compact(m, A):
+    """Create the problem in cvxpy, without the lifted per-cluster variables
+    The clusters enter through the factor of their weighted second
+    moment (see second_moment_factor), and the infimal convolution over
+    the A matrices becomes a single matrix fractional term, so that the
+    problem size is O(m^2) for any number of clusters.
+    Parameters
+    ----------
+    m: int
+        Size of each data sample
+    A: dict
+      Matrixes for the quadratic equation
+    Returns
+    -------
+    The instance and parameters of the cvxpy problem
+    """
+    # PARAMETERS #
+    dat = cp.Parameter((m, m))
+    eps = cp.Parameter()
+
+    # VARIABLES #
+    x = cp.Variable(m)
+    lam = cp.Variable()
+    Y = cp.Variable((m, m))
+
+    # OBJECTIVE #
+    objective = cp.multiply(eps, lam) + 0.5*cp.matrix_frac(Y, cp.sum([A[i]*x[i] for i in range(m)])) \
+        - cp.sum(cp.multiply(dat, Y)) + cp.quad_over_lin(Y, 4*lam)
+
+    # CONSTRAINTS #
+    constraints = [cp.sum(x) == 1]
+    constraints += [x >= 0, x <= 1]
+    constraints += [lam >= 0]
+
+    # PROBLEM #
+    problem = cp.Problem(cp.Minimize(objective), constraints)
+    return problem, x, lam, dat, eps
+
+def quadratic_experiment(A, Ainv, r, m, N_tot, K_nums, eps_nums, foldername, K_tol=None, clustering=None, store=None):
     '''Run the experiment for multiple K and epsilon
     Parameters
     ----------
     Various inputs for combinations of experiments
+    K_tol: float
+        If given, stop increasing K once the bound or the change in
+        objective over all epsilons is within K_tol
+    clustering: dict
+        Keyword arguments of mro.utils.cluster_path, e.g.
+        {"method": "stream", "chunk_size": 10000}
+    store: mro.store.SolutionStore
+        If given, write the optimal solutions in slice r of its tensors
+        instead of returning them
     Returns
     -------
-    df: dataframe
-        The results of the experiments
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
     '''
-    df = pd.DataFrame(columns = ["r","K","Epsilon","Opt_val","Eval_val","satisfy","solvetime","bound"])
-    xsols = np.zeros((len(K_nums),len(eps_nums),m, R))
+    rec = ResultRecorder(len(K_nums)*len(eps_nums), {
+        "r": int, "K": int, "Epsilon": float, "Opt_val": float, "Eval_val": float, "satisfy": bool,
+        "solvetime": float, "bound": float})
+    xsols = np.zeros((len(K_nums),len(eps_nums),m))
     d = data_modes(N_tot,m,[1,5,15,25,40])
     d2 = data_modes(N_tot,m,[1,5,15,25,40])
-    for Kcount, K in enumerate(K_nums):
-        kmeans = KMeans(n_clusters=K).fit(d)
-        weights = np.bincount(kmeans.labels_) / N_tot
+    clusters = cluster_path(d, K_nums, lazy=K_tol is not None,
+                            **(clustering or {}))
+    problem, x, lam, dat, eps = cached_problem(createproblem_quad_compact, m, A)
+    res_prev = None
+    for Kcount, (K, (centers, weights, inertia, _)) in enumerate(zip(K_nums, clusters)):
+        dat.value = second_moment_factor(centers, weights)
         for epscount, epsval in enumerate(eps_nums):
-            problem, x, s, lam, dat, eps, w = createproblem_quadnew(K, m, Ainv)
             eps.value = epsval**2
-            dat.value = kmeans.cluster_centers_
-            w.value = weights
             problem.solve()
-            evalvalue = np.mean(-0.5*(d2@np.sum([A[i]*x.value[i] for i in range(m)],axis = 0))@(d2.T))
-            xsols[Kcount, epscount, :, r] = x.value
+            xsols[Kcount, epscount, :] = x.value
             L = np.linalg.norm(np.sum([A[i]*x.value[i] for i in range(m)],axis = 0),2)
-            newrow = pd.Series(
+            rec.append(
                 {"r":r,
                  "K": K,
                  "Epsilon": epsval,
                  "Opt_val": problem.objective.value,
-                 "Eval_val": evalvalue,
-                 "satisfy": evalvalue <= problem.objective.value,
                  "solvetime": problem.solver_stats.solve_time,
-                 "bound": (L/(2*N_tot))*kmeans.inertia_
+                 "bound": (L/(2*N_tot))*inertia
             })
-            df = df.append(newrow,ignore_index = True)
-    return xsols, df
+        if K_tol is not None:
+            res = rec.select(rec["K"] == K)
+            if K_converged(res, res_prev, K_tol):
+                break
+            res_prev = res
+    rec["Eval_val"] = stream_eval(quadratic_eval, d2, xsols[:Kcount + 1], A).ravel()
+    rec["satisfy"] = rec["Eval_val"] <= rec["Opt_val"]
+    if store is not None:
+        store.write("x_sols", np.s_[..., r], xsols)
+        xsols = None
+    return xsols, rec.buffers()
   
 
+
+def setup(config):
+    """Build the inputs of run_task from a runner config
+    Parameters
+    ----------
+    config: dict
+        Runner config, with "m", "N_tot", and optionally "seed",
+        "foldername" and "clustering"
+    Returns
+    -------
+    dict
+        The data of every task
+    """
+    np.random.seed(config.get("seed", 0))
+    m = config["m"]
+    A = {}
+    Ainv = {}
+    for i in range(m):
+        A[i] = datasets.make_spd_matrix(m)
+        Ainv[i] = sc.linalg.sqrtm(np.linalg.inv(A[i]))
+    return {"A": A, "Ainv": Ainv, "m": m,
+            "N_tot": config["N_tot"],
+            "seed": config.get("seed", 0),
+            "foldername": config.get("foldername", ""),
+            "clustering": config.get("clustering")}
+
+
+def run_task(data, r, K_nums, eps_nums):
+    """Run quadratic_experiment for one replicate on part of the grid
+    The data of the replicate is drawn from a seed depending on r only,
+    so that all the tasks of a replicate share it.
+    Parameters
+    ----------
+    data: dict
+        Output of setup
+    r: int
+        Replicate
+    K_nums: vector
+        Numbers of clusters
+    eps_nums: vector
+        Epsilons
+    Returns
+    -------
+    sols: dict
+        The optimal solutions, with the K and epsilon axes first
+    df: dict
+        The results of the experiments, see mro.results.ResultRecorder
+    """
+    np.random.seed([data["seed"], r])
+    xsols, df = quadratic_experiment(data["A"], data["Ainv"], r, data["m"], data["N_tot"],
+                                     K_nums, eps_nums, data["foldername"],
+                                     clustering=data["clustering"])
+    return {"x_sols": xsols}, df
+
+
 if __name__ == '__main__':
     foldername = "concave/m10_K60_r20"
     N_tot = 60
@@ -149,18 +268,16 @@ if __name__ == '__main__':
         A[i] = datasets.make_spd_matrix(m)
         Ainv[i] = sc.linalg.sqrtm(np.linalg.inv(A[i])) 
     eps_nums = np.array([0.01, 0.015, 0.023, 0.036, 0.055, 0.085, 0.13, 0.20, 0.30, 0.5, 0.7,1, 1.2, 1.4, 1.43, 1.47, 1.51, 1.55, 1.58, 1.62, 1.66, 1.7, 1.73, 1.77, 1.81, 1.85, 1.88, 1.92, 1.96, 2, 2.02, 2.07, 2.11, 2.15, 2.18, 2.22, 2.26, 2.3, 2.5, 2.7,3,4,9,10])
+    K_tol = None    # stop increasing K once the objective changes by less
 
     njobs = get_n_processes(30)
-    results = Parallel(n_jobs=njobs)(delayed(quadratic_experiment)(
-        A, Ainv, r, m, N_tot, K_nums, eps_nums, foldername) for r in range(R))
+    store = SolutionStore("/scratch/gpfs/iywang/mro_results/" + foldername)
+    store.create("x_sols", (len(K_nums), len(eps_nums), m, R), reset=True)
+    results = Parallel(n_jobs=njobs, return_as="generator")(delayed(quadratic_experiment)(
+        A, Ainv, r, m, N_tot, K_nums, eps_nums, foldername, K_tol=K_tol, store=store) for r in range(R))
     
-    x_sols = np.zeros((len(K_nums),len(eps_nums),m, R))
-    dftemp = results[0][1]
-    for r in range(R):
-        x_sols += results[r][0]
-    for r in range(1, R):
-        dftemp = dftemp.add(results[r][1].reset_index(), fill_value=0)
-    dftemp = dftemp/R
-    np.save(Path("/scratch/gpfs/iywang/mro_results/" +
-            foldername + "/x_sols.npy"), x_sols)
+    agg = ResultAggregator()
+    for _, df_r in results:
+        agg.update(df_r)
+    dftemp = agg.to_frame()
     dftemp.to_csv('/scratch/gpfs/iywang/mro_results/' + foldername + '/df.csv')
\ No newline at end of file
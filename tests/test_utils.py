@@ -0,0 +1,50 @@
+import numpy as np
+from sklearn.cluster import KMeans
+from mro.utils import cluster_data, cluster_data_path, cluster_path
+
+
+def blobs(n, m, centers, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.vstack([rng.normal(c, 0.1, (n, m)) for c in centers])
+
+
+def test_cluster_path_matches_kmeans_on_blobs():
+    X = blobs(2000, 5, [0, 1, 2, 3])
+    path = cluster_data_path(X, [1, 2, 4], random_state=0)
+    inertia = KMeans(n_clusters=4, random_state=0).fit(X).inertia_
+    assert np.isclose(path[-1][2], inertia, rtol=1e-6)
+
+
+def test_cluster_path_no_worse_than_kmeans():
+    rng = np.random.default_rng(1)
+    X = np.vstack([rng.uniform(0.01*s, 0.02*s, (30, 10)) for s in (1, 3, 7)])
+    K_nums = [1, 2, 3, 5, 8, 10]
+    path = cluster_data_path(X, K_nums, random_state=0)
+    for K, (_, weights, inertia, _) in zip(K_nums, path):
+        assert np.isclose(np.sum(weights), 1)
+        runs = [KMeans(n_clusters=K, random_state=seed).fit(X).inertia_ for seed in range(5)]
+        assert inertia <= 1.05*np.median(runs)
+
+
+def test_stream_clustering_ignores_data_order(tmp_path):
+    X = blobs(2000, 3, [0, 1, 2, 3])
+    np.save(tmp_path / "blobs.npy", X)
+    centers, weights = cluster_data(str(tmp_path / "blobs.npy"), 4, method="stream",
+                                    chunk_size=500, random_state=0)
+    order = np.argsort(centers[:, 0])
+    assert np.allclose(centers[order, 0], [0, 1, 2, 3], atol=0.05)
+    assert np.allclose(weights[order], 0.25, atol=0.01)
+
+
+def test_cluster_path_methods(tmp_path):
+    X = blobs(1000, 3, [0, 1, 2, 3])
+    np.save(tmp_path / "blobs.npy", X)
+    K_nums = [2, 4]
+    for method in ("minibatch", "stream"):
+        path = cluster_path(str(tmp_path / "blobs.npy") if method == "stream" else X,
+                            K_nums, lazy=True, method=method, chunk_size=500, random_state=0)
+        centers, weights, inertia, _ = list(path)[-1]
+        assert centers.shape == (4, 3)
+        assert np.isclose(np.sum(weights), 1)
+        assert np.isclose(inertia, np.sum(np.min(
+            np.sum((X[:, None] - centers[None])**2, axis=-1), axis=1)))